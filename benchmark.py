@@ -0,0 +1,278 @@
+import argparse
+import copy
+import math
+import time
+from contextlib import suppress
+
+import einops
+import torch
+import torch.nn.functional as F
+from tabulate import tabulate
+from torch.profiler import profile, ProfilerActivity
+
+from modeling import cfg, build_model
+from modeling.cpu_profile import bf16_supported
+from modeling.e2e_compressed_model_tip import GroupSimilarity, SPoS, group_cosine_similarity
+
+
+def spos_reference(inputs, temporal_module, k):
+    """Per-offset SPoS, one temporal module call for each offset. (b c t)"""
+    B = inputs.shape[0]
+    L = inputs.shape[-1]
+
+    padded_inputs = F.pad(inputs, pad=(0, math.ceil(L / k) * k - L), mode='replicate')
+    pad_L = padded_inputs.shape[-1]
+
+    outputs = torch.zeros(B, temporal_module.out_channels, pad_L, dtype=inputs.dtype, device=inputs.device)
+    for offset in range(k):
+        left_x = F.pad(padded_inputs, pad=(k - offset, 0), mode='replicate')[:, :, :-(k - offset)]
+        right_x = F.pad(padded_inputs, pad=(0, offset + 1), mode='replicate')[:, :, (offset + 1):]
+        left_seq = einops.rearrange(left_x, 'b c (nw k) -> (b nw) k c', k=k)
+        right_seq = einops.rearrange(right_x, 'b c (nw k) -> (b nw) k c', k=k)
+        mid_seq = einops.rearrange(padded_inputs[:, :, offset::k], 'b c nw -> (b nw) 1 c')
+
+        h = temporal_module(left_seq, mid_seq, right_seq)  # (b nw) c
+        outputs[:, :, offset::k] = einops.rearrange(h, '(b nw) c -> b c nw', b=B)
+
+    return outputs[:, :, :L]
+
+
+def measure(fn, device, warmup=2, repeats=10):
+    for _ in range(warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def cosine_similarity_reference(x):
+    """Broadcast cosine similarity of grouped features. (B, L, G, C') -> (B, G, L, L)"""
+    return F.cosine_similarity(x.unsqueeze(2), x.unsqueeze(1), dim=-1).permute(0, 3, 1, 2)
+
+
+def peak_memory(fn, device):
+    """Peak bytes allocated while running fn, on top of what was already allocated."""
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        fn()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated(device) - base
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    # replay allocations/frees of the leaf ops in order
+    current = peak = 0
+    for event in sorted(prof.events(), key=lambda e: e.time_range.start):
+        if len(event.cpu_children) == 0:
+            current += event.self_cpu_memory_usage
+            peak = max(peak, current)
+    return peak
+
+
+def saved_memory(fn, exclude=()):
+    """Bytes of the tensors autograd keeps for backward while running fn, each storage once, except the `exclude` tensors."""
+    excluded = {t.data_ptr() for t in exclude}
+    saved = {}
+
+    def pack(tensor):
+        if tensor.data_ptr() not in excluded:
+            storage = tensor.storage()
+            saved[storage.data_ptr()] = storage.size() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        outputs = fn()
+    return sum(saved.values()), outputs
+
+
+@torch.no_grad()
+def bench_spos(args, device):
+    k = args.kernel_size
+    temporal_module = GroupSimilarity(dim=args.dim, window_size=k, group=4, similarity_func='cosine').to(device).eval()
+
+    rows = []
+    for L in args.lengths:
+        feats = torch.randn(args.batch_size, args.dim, L, device=device)
+        expected = spos_reference(feats, temporal_module, k)
+        outputs = SPoS(feats, temporal_module, k)
+        max_diff = (outputs - expected).abs().max().item()
+
+        loop_time = measure(lambda: spos_reference(feats, temporal_module, k), device, repeats=args.repeats)
+        batched_time = measure(lambda: SPoS(feats, temporal_module, k), device, repeats=args.repeats)
+        rows.append([L, loop_time * 1000, batched_time * 1000, loop_time / batched_time, max_diff])
+
+    print(tabulate(rows, headers=['Length', 'Loop(ms)', 'Batched(ms)', 'Speedup', 'Max diff'], floatfmt='.4f'))
+
+
+@torch.no_grad()
+def bench_similarity(args, device):
+    rows = []
+    for batch_size in args.batch_sizes:
+        x = torch.randn(batch_size, 2 * args.kernel_size + 1, args.group, args.dim // args.group, device=device)
+        max_diff = (group_cosine_similarity(x) - cosine_similarity_reference(x)).abs().max().item()
+        row = [batch_size]
+        for fn in [cosine_similarity_reference, group_cosine_similarity]:
+            row.append(peak_memory(lambda: fn(x), device) / 2 ** 20)
+            row.append(measure(lambda: fn(x), device, repeats=args.repeats) * 1000)
+        rows.append(row + [max_diff])
+
+    print(tabulate(rows, headers=['Batch', 'Broadcast(MB)', 'Broadcast(ms)', 'Matmul(MB)', 'Matmul(ms)', 'Max diff'], floatfmt='.4f'))
+
+
+def bench_cpu_profile(args, device):
+    assert device.type == 'cpu', 'cpu-profile runs on --device cpu.'
+    cfg.merge_from_file(args.config_file)
+    cfg.freeze()
+    model = build_model(cfg).eval()
+    if args.resume:
+        model.load_state_dict(torch.load(args.resume, map_location='cpu')['model'])
+
+    size = args.image_size
+    inputs = {
+        'imgs': torch.randn(args.batch_size, args.seq_len, 3, size, size),
+        'mv': torch.randn(args.batch_size, args.seq_len, 2, size, size),
+        'res': torch.randn(args.batch_size, args.seq_len, 3, size, size),
+        'frame_mask': torch.ones(args.batch_size, args.seq_len),
+    }
+    num_frames = args.batch_size * args.seq_len
+
+    profiles = [('fp32', False, False), ('channels_last', True, False)]
+    if bf16_supported():
+        profiles += [('bf16', False, True), ('channels_last + bf16', True, True)]
+    else:
+        print('No native bf16 on this CPU, skipping the bf16 profiles.')
+
+    rows = []
+    reference = None
+    for name, channels_last, bf16 in profiles:
+        m = copy.deepcopy(model)
+        if channels_last:
+            m = m.to(memory_format=torch.channels_last)
+        auto_cast = (lambda: torch.autocast('cpu', dtype=torch.bfloat16)) if bf16 else suppress
+
+        def fn():
+            with torch.no_grad(), auto_cast():
+                return m(inputs)[0].float()
+
+        scores = fn()
+        if reference is None:
+            reference = scores
+        max_diff = (scores - reference).abs().max().item()
+        ms = measure(fn, device, repeats=args.repeats) * 1000
+        rows.append([name, max_diff, max_diff <= (args.bf16_atol if bf16 else args.atol), ms / num_frames, num_frames * 1000 / ms])
+    for row in rows:
+        row.append(rows[0][3] / row[3])
+
+    print(f'{torch.get_num_threads()} threads, batch {args.batch_size} x {args.seq_len} frames at {size}x{size}')
+    print(tabulate(rows, headers=['Profile', 'Max diff', 'OK', 'ms/frame', 'Frames/s', 'Speedup'], floatfmt='.4f'))
+
+
+def bench_checkpoint(args, device):
+    base_cfg = cfg.clone()
+    base_cfg.merge_from_file(args.config_file)
+    layers = ['layer1', 'layer2', 'layer3', 'layer4']
+    settings = [
+        ('none', {}),
+        ('similarity', {'SIMILARITY': True}),
+        ('estimators', {'ESTIMATORS': True}),
+        ('side-data', {'SIDE_DATA': layers}),
+        ('backbone', {'BACKBONE': layers}),
+        ('all', {'BACKBONE': layers, 'SIDE_DATA': layers, 'ESTIMATORS': True, 'SIMILARITY': True}),
+    ]
+
+    size = args.image_size
+    inputs = {
+        'imgs': torch.randn(args.batch_size, args.seq_len, 3, size, size, device=device),
+        'mv': torch.randn(args.batch_size, args.seq_len, 2, size, size, device=device),
+        'res': torch.randn(args.batch_size, args.seq_len, 3, size, size, device=device),
+        'frame_mask': torch.ones(args.batch_size, args.seq_len, device=device),
+    }
+    targets = (torch.rand(args.batch_size, args.seq_len, device=device) < 0.1).float()
+
+    rows = []
+    state_dict = None
+    reference = None
+    for name, checkpoint_cfg in settings:
+        setting_cfg = base_cfg.clone()
+        for key, value in checkpoint_cfg.items():
+            setting_cfg.MODEL.CHECKPOINT[key] = value
+        model = build_model(setting_cfg).to(device).train()
+        if state_dict is None:
+            state_dict = copy.deepcopy(model.state_dict())
+        model.load_state_dict(state_dict)
+        params = [p for p in model.parameters() if p.requires_grad]
+
+        def forward():
+            for p in params:
+                p.grad = None
+            return sum(model(inputs, targets).values())
+
+        def fn():
+            forward().backward()
+
+        # activations kept for backward (a checkpointed stage keeps its input only), the parameters are left out
+        activations, loss = saved_memory(forward, exclude=list(model.parameters()))
+        loss.backward()
+        grads = torch.cat([p.grad.flatten() for p in params if p.grad is not None])
+        if reference is None:
+            reference = grads
+        max_diff = (grads - reference).abs().max().item()
+        # the profiler replay of peak_memory misses the allocations of the backward recomputation on cpu
+        peak = peak_memory(fn, device) / 2 ** 20 if device.type == 'cuda' else '-'
+        ms = measure(fn, device, warmup=1, repeats=args.repeats) * 1000
+        rows.append([name, max_diff, activations / 2 ** 20, peak, ms])
+        del model, loss
+    for row in rows:
+        row.extend([row[2] / rows[0][2], row[4] / rows[0][4]])
+
+    print(f'Training step of batch {args.batch_size} x {args.seq_len} frames at {size}x{size} on {device}')
+    print(tabulate(rows, headers=['Checkpointed', 'Max grad diff', 'Activations (MB)', 'Peak (MB)', 'Step (ms)', 'Activation ratio', 'Time ratio'],
+                   floatfmt='.4f'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--repeats", type=int, default=10)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    spos_parser = subparsers.add_parser('spos', help='per-offset vs batched SPoS')
+    spos_parser.add_argument("--batch-size", type=int, default=4)
+    spos_parser.add_argument("--dim", type=int, default=256)
+    spos_parser.add_argument("--kernel-size", type=int, default=8)
+    spos_parser.add_argument("--lengths", type=int, nargs='+', default=[25, 50, 100, 200, 400])
+    spos_parser.set_defaults(func=bench_spos)
+
+    similarity_parser = subparsers.add_parser('similarity', help='broadcast vs matmul grouped cosine similarity')
+    similarity_parser.add_argument("--dim", type=int, default=256)
+    similarity_parser.add_argument("--group", type=int, default=4)
+    similarity_parser.add_argument("--kernel-size", type=int, default=8)
+    similarity_parser.add_argument("--batch-sizes", type=int, nargs='+', default=[100, 400, 1600])
+    similarity_parser.set_defaults(func=bench_similarity)
+
+    cpu_parser = subparsers.add_parser('cpu-profile', help='E2ECompressedGEBDModel scores and throughput with channels_last / bf16 autocast on cpu')
+    cpu_parser.add_argument("--config-file", type=str, default='config/end_to_end_sidedata_mv_res.yaml')
+    cpu_parser.add_argument("--resume", type=str, default='')
+    cpu_parser.add_argument("--batch-size", type=int, default=1)
+    cpu_parser.add_argument("--seq-len", type=int, default=100)
+    cpu_parser.add_argument("--image-size", type=int, default=224)
+    cpu_parser.add_argument("--atol", type=float, default=1e-4, help='max score diff of the fp32 profiles')
+    cpu_parser.add_argument("--bf16-atol", type=float, default=2e-2, help='max score diff of the bf16 profiles')
+    cpu_parser.set_defaults(func=bench_cpu_profile)
+
+    checkpoint_parser = subparsers.add_parser('checkpoint', help='peak memory and time of a training step with each MODEL.CHECKPOINT setting')
+    checkpoint_parser.add_argument("--config-file", type=str, default='config/end_to_end_sidedata_mv_res.yaml')
+    checkpoint_parser.add_argument("--batch-size", type=int, default=2)
+    checkpoint_parser.add_argument("--seq-len", type=int, default=100)
+    checkpoint_parser.add_argument("--image-size", type=int, default=224)
+    checkpoint_parser.set_defaults(func=bench_checkpoint)
+
+    args = parser.parse_args()
+    args.func(args, torch.device(args.device))
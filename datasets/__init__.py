@@ -4,17 +4,18 @@ import os
 from torch.utils.data import DataLoader, DistributedSampler, RandomSampler, SequentialSampler, ConcatDataset
 from torch.utils.data.dataloader import default_collate
 
+from utils.resources import plan_resources
 from utils.sampler import DistBalancedBatchSampler
 # from .dataset_old import GEBDDataset, ClipShotsDataset, MeixueDataset
-from .dataset import GEBDDataset
+from .dataset import GEBDDataset, VideoFileDataset, load_compressed_video
 
 ROOT = os.getenv('GEBD_ROOT', '/mnt/bn/hevc-understanding/datasets/GEBD/')
 
 
-def build_dataloader(cfg, args, splits, is_train):
+def build_dataset(cfg, args, splits, is_train):
     assert len(splits) >= 1
 
-    def build_dataset(split):
+    def build_split(split):
         folder = {
             'train': 'GEBD_train_frames',
             'val': 'GEBD_val_frames',
@@ -28,13 +29,14 @@ def build_dataloader(cfg, args, splits, is_train):
         dataset = GEBDDataset(cfg, root=root,
                               split=split,
                               train=is_train)
-        if args.device == 'cpu':
+        if args.device == 'cpu' and not args.distributed:
+            # single cpu process: a quick run on a subset, several (gloo) processes share the whole split
             dataset.annotations = dataset.annotations[:500]
         return dataset
 
     datasets = []
     for split in splits:
-        datasets.append(build_dataset(split))
+        datasets.append(build_split(split))
 
     if len(datasets) == 1:
         dataset = datasets[0]
@@ -44,6 +46,12 @@ def build_dataloader(cfg, args, splits, is_train):
             annotations.extend(copy.deepcopy(dataset.annotations))
         dataset = ConcatDataset(datasets)
         dataset.annotations = annotations
+    return dataset
+
+
+def build_dataloader(cfg, args, splits, is_train, plan=None):
+    """`plan`: the ResourcePlan the main process already applied, planned here (CPU.PLAN_RESOURCES) when not given."""
+    dataset = build_dataset(cfg, args, splits, is_train)
 
     if args.distributed:
         if is_train and not cfg.INPUT.END_TO_END:
@@ -55,10 +63,19 @@ def build_dataloader(cfg, args, splits, is_train):
 
     # collate_fn = (lambda x: x) if cfg.INPUT.END_TO_END else default_collate
     collate_fn = default_collate
+    if cfg.INPUT.END_TO_END and not is_train and cfg.TEST.CHUNK_SIZE > 0:
+        # whole videos of different lengths, ChunkedGEBDDetector batches their windows
+        collate_fn = list
+    num_workers, worker_init_fn = cfg.SOLVER.NUM_WORKERS, None
+    if plan is None and args.device == 'cpu' and cfg.CPU.PLAN_RESOURCES:
+        plan = plan_resources(cfg)
+    if plan is not None:
+        num_workers, worker_init_fn = plan.num_workers, plan.init_worker
     loader = DataLoader(dataset, batch_size=cfg.SOLVER.BATCH_SIZE,
                         sampler=sampler,
                         drop_last=False,
                         collate_fn=collate_fn,
                         # pin_memory=True,
-                        num_workers=cfg.SOLVER.NUM_WORKERS)
+                        num_workers=num_workers,
+                        worker_init_fn=worker_init_fn)
     return loader
@@ -1,6 +1,7 @@
 import math
 import os
 import pickle
+import time
 from typing import List
 
 import cv2
@@ -12,7 +13,17 @@ from torch.utils.data import Dataset
 import torch.nn.functional as F
 from torchvision import transforms
 
+from modeling.e2e_compressed_model_tip import GOP
 from utils.distribute import synchronize, is_main_process
+from utils.feature_store import FeatureReader
+
+
+rgb_transform = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                         std=[0.229, 0.224, 0.225])
+])
 
 
 def image_loader(path):
@@ -22,16 +33,18 @@ def image_loader(path):
         return img.convert('RGB')
 
 
-def prepare_annotations(cfg, root, split):
+def prepare_annotations(cfg, root, split, full_video=False):
     frame_per_side = cfg.INPUT.FRAME_PER_SIDE
     ds = cfg.INPUT.DOWNSAMPLE
     dynamic_downsample = cfg.INPUT.DYNAMIC_DOWNSAMPLE
     min_change_dur = 0.3
+    if full_video and cfg.INPUT.USE_SIDE_DATA:
+        check_i_frame_downsample(ds, dynamic_downsample)
 
     ann_path = os.path.join('data', f'k400_mr345_{split}_min_change_duration0.3.pkl')
     filename = '{}-cache-fps{}-ds{}.pkl'.format(split, frame_per_side, f'_dynamic{ds}' if dynamic_downsample else ds)
     if cfg.INPUT.END_TO_END:
-        filename = 'end_to_end{}_'.format(cfg.INPUT.SEQUENCE_LENGTH) + filename
+        filename = 'end_to_end{}_'.format('_full' if full_video else cfg.INPUT.SEQUENCE_LENGTH) + filename
     if cfg.INPUT.USE_GOP:
         filename = 'gop_' + filename
     cache_path = os.path.join('data', 'caches', filename)
@@ -71,7 +84,10 @@ def prepare_annotations(cfg, root, split):
                 max_boundary = len(change_indices)
 
             if cfg.INPUT.END_TO_END:
-                if cfg.INPUT.USE_GOP:
+                if full_video:
+                    # every `downsample`-th frame of the whole video, scored in chunks (TEST.CHUNK_SIZE)
+                    selected_indices = np.arange(1, vlen + 1, downsample)
+                elif cfg.INPUT.USE_GOP:
                     indices = np.arange(1, min(300, vlen) + 1, dtype=int)
                     if len(indices) < 300:
                         indices = np.concatenate((indices, np.ones((300 - len(indices),), dtype=int) * -1))
@@ -164,11 +180,21 @@ def prepare_annotations(cfg, root, split):
     return annotations
 
 
+I_FRAME_INTERVAL = 12  # frames between two I-frames of the mp4s
+
+
 def is_I_frame(frame_idx):
     if frame_idx == -1:
         return False
     assert frame_idx >= 1
-    return (frame_idx - 1) % 12 == 0
+    return (frame_idx - 1) % I_FRAME_INTERVAL == 0
+
+
+def check_i_frame_downsample(downsample, dynamic_downsample=False):
+    """Every `downsample`-th frame of a whole video puts its I-frames at every GOP-th position, where the model reads them."""
+    assert not dynamic_downsample and downsample * GOP == I_FRAME_INTERVAL, \
+        'Whole videos need INPUT.DOWNSAMPLE x GOP ({}) = {} and INPUT.DYNAMIC_DOWNSAMPLE False, ' \
+        'otherwise the I-frame backbone gets zero images.'.format(GOP, I_FRAME_INTERVAL)
 
 
 def preprocess_residual(res):
@@ -251,9 +277,100 @@ def load_side_data(video_path: str, frame_idxs: List):
     return sidedata_dict
 
 
+DECODER_THREADS = 0  # ffmpeg threads of cv2.VideoCapture, 0 lets ffmpeg decide (one per core)
+
+
+def set_decoder_threads(num_threads):
+    """Decoder threads of the videos opened by this process, set per DataLoader worker by the resource planner."""
+    global DECODER_THREADS
+    DECODER_THREADS = num_threads
+
+
+def open_video(video_path: str):
+    if DECODER_THREADS > 0 and hasattr(cv2, 'CAP_PROP_N_THREADS'):
+        return cv2.VideoCapture(video_path, cv2.CAP_ANY, [cv2.CAP_PROP_N_THREADS, DECODER_THREADS])
+    return cv2.VideoCapture(video_path)
+
+
+def load_i_frames(video_path: str):
+    """
+    RGB of the I-frames (see `is_I_frame`) of an mp4, other frames are only grabbed, not converted.
+    Returns:
+        {frame_idx: (3, 224, 224)}, number of frames, fps
+    """
+    cap = open_video(video_path)
+    assert cap.isOpened(), f'Can not open {video_path}!'
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    i_frames = {}
+    num_frames = 0
+    while cap.grab():
+        num_frames += 1
+        if is_I_frame(num_frames):
+            _, frame = cap.retrieve()
+            i_frames[num_frames] = rgb_transform(Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+    cap.release()
+    return i_frames, num_frames, fps
+
+
+def stack_frames(tensors, shape):
+    """(N, *shape) stack of per-frame tensors, also when there are none."""
+    return torch.stack(tensors, dim=0) if len(tensors) > 0 else torch.zeros((0,) + shape, dtype=torch.float32)
+
+
+def load_compressed_video(video_path: str, downsample=3):
+    """
+    Model inputs of every `downsample`-th frame of an mp4, straight from the compressed stream:
+    RGB for I-frames, motion vectors and residuals for P-frames, like `GEBDDataset` with side data.
+    Only the inputs a frame has are kept, the zeros of the other type are added per window by
+    `modeling.chunked.chunk_window`, so the memory of a video is not that of three dense tensors.
+    Returns:
+        frame_indices (T,), {'imgs': (T_i, 3, 224, 224) of the I-frames, 'mv': (T_p, 2, 224, 224) and
+        'res': (T_p, 3, 224, 224) of the P-frames, 'frame_mask': (T,), 'i_frame_mask': (T,) bool}, fps
+    """
+    check_i_frame_downsample(downsample)
+    i_frames, num_frames, fps = load_i_frames(video_path)
+    frame_indices = np.arange(1, num_frames + 1, downsample)
+    i_frame_mask = [is_I_frame(frame_idx) for frame_idx in frame_indices.tolist()]
+    p_frame_idxs = [frame_idx for frame_idx, is_i in zip(frame_indices.tolist(), i_frame_mask) if not is_i]
+    sidedata_dict = load_side_data(video_path, list(p_frame_idxs))
+
+    inputs = {
+        'imgs': stack_frames([i_frames[frame_idx] for frame_idx, is_i in zip(frame_indices.tolist(), i_frame_mask) if is_i], (3, 224, 224)),
+        'mv': stack_frames([sidedata_dict[frame_idx]['mv'] for frame_idx in p_frame_idxs], (2, 224, 224)),
+        'res': stack_frames([sidedata_dict[frame_idx]['res'] for frame_idx in p_frame_idxs], (3, 224, 224)),
+        'frame_mask': torch.ones(len(frame_indices), dtype=torch.int64),
+        'i_frame_mask': torch.tensor(i_frame_mask, dtype=torch.bool),
+    }
+    return frame_indices, inputs, fps
+
+
+class VideoFileDataset(Dataset):
+    """Whole mp4 videos decoded with `load_compressed_video`, for inference. Use with batch_size=None."""
+
+    def __init__(self, video_paths, downsample=3):
+        self.video_paths = video_paths
+        self.downsample = downsample
+
+    def __len__(self):
+        return len(self.video_paths)
+
+    def __getitem__(self, index):
+        video_path = self.video_paths[index]
+        start = time.time()
+        frame_indices, inputs, fps = load_compressed_video(video_path, self.downsample)
+        return {
+            'vid': os.path.splitext(os.path.basename(video_path))[0],
+            'frame_indices': frame_indices,
+            'inputs': inputs,
+            'fps': fps,
+            'decode_time': time.time() - start,
+        }
+
+
 class GEBDDataset(Dataset):
     def __init__(self, cfg, root, split, train=True):
-        annotations = prepare_annotations(cfg, root, split)
+        self.full_video = cfg.INPUT.END_TO_END and not train and cfg.TEST.CHUNK_SIZE > 0
+        annotations = prepare_annotations(cfg, root, split, full_video=self.full_video)
         self._use_side_data = cfg.INPUT.USE_SIDE_DATA
         self._load_mv_res = cfg.MODEL.NAME in ('CompressedGEBDModel', 'E2ECompressedGEBDModel')
 
@@ -263,16 +380,46 @@ class GEBDDataset(Dataset):
         self.split = split
         self.train = train
         self.annotations = annotations
-        self.transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                 std=[0.229, 0.224, 0.225])
-        ])
+        self.transform = rgb_transform
+        # training reads precomputed I-frame features instead of decoding the I-frames (MODEL.I_FEATURE_STORE)
+        self.i_feature_store = cfg.MODEL.I_FEATURE_STORE if train else ''
+        self._i_feature_reader = None
 
     def __len__(self):
         return len(self.annotations)
 
+    def load_imgs(self, folder, block_idx):
+        """RGB of the I-frames of a window (see `is_I_frame`), zeros at the other frames."""
+        return [(self.transform(image_loader(os.path.join(self.root, folder, 'image_{:05d}.jpg'.format(frame_idx))))
+                 if is_I_frame(frame_idx) else torch.zeros(3, 224, 224, dtype=torch.float32))
+                for frame_idx in block_idx]
+
+    def load_i_feats(self, vid):
+        """(num_gop, C, h, w) float16 extract_features outputs of the window of `vid`, from MODEL.I_FEATURE_STORE."""
+        if self._i_feature_reader is None:
+            # memory-mapped by each DataLoader worker
+            self._i_feature_reader = FeatureReader(self.i_feature_store)
+        assert vid in self._i_feature_reader.index, f'{vid} is not in {self.i_feature_store}, rerun precompute_i_features.py.'
+        _, feats = self._i_feature_reader[vid]
+        return torch.from_numpy(np.array(feats))
+
+    def load_full_video(self, sample, folder, video_path, block_idx):
+        """
+        Side data inputs of a whole video (TEST.CHUNK_SIZE > 0) like `load_compressed_video`: imgs of the I-frames
+        and mv/res of the P-frames only, expanded per window by `modeling.chunked.chunk_window`.
+        """
+        i_frame_mask = [is_I_frame(frame_idx) for frame_idx in block_idx]
+        p_frame_idxs = [frame_idx for frame_idx, is_i in zip(block_idx, i_frame_mask) if not is_i]
+        sidedata_dict = load_side_data(video_path, list(p_frame_idxs))
+
+        sample['imgs'] = stack_frames([self.transform(image_loader(os.path.join(self.root, folder, 'image_{:05d}.jpg'.format(frame_idx))))
+                                       for frame_idx, is_i in zip(block_idx, i_frame_mask) if is_i], (3, 224, 224))
+        sample['mv'] = stack_frames([sidedata_dict[frame_idx]['mv'] for frame_idx in p_frame_idxs], (2, 224, 224))
+        sample['res'] = stack_frames([sidedata_dict[frame_idx]['res'] for frame_idx in p_frame_idxs], (3, 224, 224))
+        sample['frame_mask'] = torch.ones(len(block_idx), dtype=torch.int64)
+        sample['i_frame_mask'] = torch.tensor(i_frame_mask, dtype=torch.bool)
+        return sample
+
     def __getitem__(self, index):
         item = self.annotations[index]
         vid = item['vid']
@@ -281,14 +428,21 @@ class GEBDDataset(Dataset):
 
         video_path = os.path.join(self.root[:-len('frames')] + 'videos_mpeg4', folder + '.mp4')
 
+        if self.full_video and self._use_side_data and self._load_mv_res:
+            sample = {
+                'labels': torch.tensor(item['label'], dtype=torch.int64),
+                'vid': vid,
+                'video_path': video_path,
+                'frame_indices': torch.tensor(block_idx),
+            }
+            return self.load_full_video(sample, folder, video_path, block_idx)
+
         mv_list = None
         res_list = None
         frame_mask = None
         if self._use_side_data:
             # side data baseline
-            imgs = [(self.transform(image_loader(os.path.join(self.root, folder, 'image_{:05d}.jpg'.format(frame_idx))))
-                     if is_I_frame(frame_idx) else torch.zeros(3, 224, 224, dtype=torch.float32))
-                    for frame_idx in block_idx]
+            imgs = None if self.i_feature_store else self.load_imgs(folder, block_idx)
 
             if self._load_mv_res:
                 mv_list = []
@@ -312,13 +466,15 @@ class GEBDDataset(Dataset):
         else:
             imgs = [self.transform(image_loader(os.path.join(self.root, folder, 'image_{:05d}.jpg'.format(i)))) for i in block_idx]
 
-        imgs = torch.stack(imgs, dim=0)
         sample = {
-            'imgs': imgs,
             'labels': torch.tensor(item['label'], dtype=torch.int64),
             'vid': vid,
             'video_path': video_path,
         }
+        if imgs is not None:
+            sample['imgs'] = torch.stack(imgs, dim=0)
+        else:
+            sample['i_feats'] = self.load_i_feats(vid)
         if self.cfg.INPUT.END_TO_END:
             sample['frame_indices'] = torch.tensor(block_idx)
             # sample['frame_mask'] = torch.tensor(frame_mask)
@@ -0,0 +1,152 @@
+import argparse
+import inspect
+import os
+import time
+import warnings
+
+import numpy as np
+import torch
+from tabulate import tabulate
+
+from inference import load_model
+from modeling import cfg
+from modeling.e2e_compressed_model_tip import GOP
+
+
+class GEBDInferenceModule(torch.nn.Module):
+    """Tensor-in tensor-out inference path of E2ECompressedGEBDModel: (imgs, mv, res) -> scores (B, T)."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.eval()
+
+    def forward(self, imgs, mv, res):
+        feats = self.model.encode({'imgs': imgs, 'mv': mv, 'res': res})
+        return torch.sigmoid(self.model.head(feats)).flatten(1)
+
+
+def make_inputs(batch_size, seq_len, image_size):
+    return (torch.randn(batch_size, seq_len, 3, image_size, image_size),
+            torch.randn(batch_size, seq_len, 2, image_size, image_size),
+            torch.randn(batch_size, seq_len, 3, image_size, image_size))
+
+
+def export_torchscript(module, example_inputs, path):
+    with torch.no_grad(), warnings.catch_warnings():
+        # the asserts on the (constant) window size in GroupSimilarity are traced as constants
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        traced = torch.jit.trace(module, example_inputs, check_trace=False)
+        traced = torch.jit.freeze(traced)
+    traced.save(path)
+    return torch.jit.load(path)
+
+
+def export_onnx(module, example_inputs, path, opset):
+    import onnxruntime
+
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    dynamic_axes = {name: {0: 'batch', 1: 'time'} for name in ('imgs', 'mv', 'res', 'scores')}
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        torch.onnx.export(module, example_inputs, path,
+                          input_names=['imgs', 'mv', 'res'],
+                          output_names=['scores'],
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset,
+                          **kwargs)
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+
+    def run(imgs, mv, res):
+        scores, = session.run(None, {'imgs': imgs.numpy(), 'mv': mv.numpy(), 'res': res.numpy()})
+        return torch.from_numpy(scores)
+
+    return run
+
+
+def measure(fn, inputs, warmup=2, repeats=10):
+    """Median wall time of fn(*inputs) in ms."""
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(*inputs)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn(*inputs)
+            times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times))
+
+
+def main(cfg, args):
+    assert args.seq_len % GOP == 0 and all(t % GOP == 0 for t in args.check_seq_lens), f'Sequence lengths must be multiples of GOP={GOP}.'
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    model = load_model(cfg, args.resume, torch.device('cpu'))
+    module = GEBDInferenceModule(model)
+    example_inputs = make_inputs(args.batch_size, args.seq_len, args.image_size)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+
+    runtimes = {'eager': module}
+    if args.format in ('torchscript', 'all'):
+        path = args.output + '.pt'
+        runtimes['torchscript'] = export_torchscript(module, example_inputs, path)
+        print(f'Saved TorchScript to {path}.')
+    if args.format in ('onnx', 'all'):
+        path = args.output + '.onnx'
+        runtimes['onnx'] = export_onnx(module, example_inputs, path, args.opset)
+        print(f'Saved ONNX to {path}.')
+
+    # parity on other batch sizes / lengths than the traced ones, to check the dynamic axes
+    shapes = [(args.batch_size, args.seq_len)] + [(b, t) for b in args.check_batch_sizes for t in args.check_seq_lens]
+    rows = []
+    failed = False
+    for batch_size, seq_len in shapes:
+        inputs = make_inputs(batch_size, seq_len, args.image_size)
+        with torch.no_grad():
+            reference = module(*inputs)
+        row = [f'{batch_size}x{seq_len}']
+        for name, fn in runtimes.items():
+            if name == 'eager':
+                row.append(measure(fn, inputs, repeats=args.repeats))
+                continue
+            with torch.no_grad():
+                diff = (fn(*inputs) - reference).abs().max().item()
+            failed |= diff > args.atol
+            row.extend([diff, measure(fn, inputs, repeats=args.repeats)])
+        rows.append(row)
+
+    headers = ['B x T', 'eager (ms)']
+    for name in runtimes:
+        if name != 'eager':
+            headers.extend([f'{name} max diff', f'{name} (ms)'])
+    print(tabulate(rows, headers=headers, floatfmt='.6g'))
+    if failed:
+        raise RuntimeError(f'Exported model differs from eager PyTorch by more than {args.atol}.')
+    print(f'Parity OK (atol {args.atol}).')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the inference path to TorchScript / ONNX, check parity and CPU latency against eager PyTorch.')
+    parser.add_argument("--config-file", help="path to config file", type=str)
+    parser.add_argument("--resume", type=str)
+    parser.add_argument("--format", type=str, default='all', choices=['torchscript', 'onnx', 'all'])
+    parser.add_argument("--output", type=str, default='exported/gebd', help='path prefix, .pt / .onnx are appended')
+    parser.add_argument("--opset", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=1, help='batch size of the traced example')
+    parser.add_argument("--seq-len", type=int, default=100, help='frames of the traced example')
+    parser.add_argument("--image-size", type=int, default=224)
+    parser.add_argument("--check-batch-sizes", type=int, nargs='+', default=[2])
+    parser.add_argument("--check-seq-lens", type=int, nargs='+', default=[48, 160])
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0, help='torch intra-op threads, 0 keeps the default')
+    parser.add_argument("opts", help="Modify config options using the command-line", default=None, nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    main(cfg, args)
@@ -1,132 +1,240 @@
 import argparse
 import glob
+import json
 import os
-import pickle
+import queue
+import threading
+import time
 
-import cv2
-import numpy as np
 import torch
-import torch.distributed as dist
-from PIL import Image
-from torchvision import transforms
-
-from modeling import cfg, build_model
-from utils.distribute import is_main_process
-
-
-def get_idx_from_score_by_threshold(threshold=0.5, seq_indices=None, seq_scores=None):
-    seq_indices = np.array(seq_indices)
-    seq_scores = np.array(seq_scores)
-    bdy_indices = []
-    internals_indices = []
-    for i in range(len(seq_scores)):
-        if seq_scores[i] >= threshold:
-            internals_indices.append(i)
-        elif seq_scores[i] < threshold and len(internals_indices) != 0:
-            bdy_indices.append(internals_indices)
-            internals_indices = []
-
-        if i == len(seq_scores) - 1 and len(internals_indices) != 0:
-            bdy_indices.append(internals_indices)
-
-    bdy_indices_in_video = []
-    if len(bdy_indices) != 0:
-        for internals in bdy_indices:
-            center = int(np.mean(internals))
-            bdy_indices_in_video.append(seq_indices[center])
-    return bdy_indices_in_video
-
-
-def image_loader(path):
-    # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
-    with open(path, 'rb') as f:
-        img = Image.open(f)
-        return img.convert('RGB')
-
-
-def load_frames(frames_dir):
-    num_frames = len(os.listdir(frames_dir))
-    frame_indices = np.arange(1, num_frames + 1, 1)
-    frame_paths = []
-    for idx in frame_indices:
-        frame_paths.append(os.path.join(frames_dir, 'image_%05d.jpg' % idx))
-
-    transform = transforms.Compose([
-        transforms.Resize((128, 128)),
-        transforms.ToTensor(),
-        # transforms.Normalize(mean=[0.485, 0.456, 0.406],
-        #                      std=[0.229, 0.224, 0.225])
-    ])
-
-    imgs = [transform(image_loader(path)) for path in frame_paths]
-    imgs = torch.stack(imgs, dim=0) * 2.0 - 1.0
-    return imgs, frame_indices
-
-
-@torch.no_grad()
-def main(cfg, args):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+from tabulate import tabulate
+from torch.utils.data import DataLoader
+
+from datasets import VideoFileDataset
+from modeling import cfg, build_model, ChunkedGEBDDetector, optimize_for_inference
+from modeling.cpu_profile import apply_cpu_profile, build_autocast
+from modeling.e2e_compressed_model_tip import GOP
+from modeling.optimize import InferenceGEBDModel
+from utils.boundary import get_idx_from_score_by_threshold
+from utils.distribute import all_gather, get_rank, get_world_size, init_distributed, is_main_process, synchronize
+from utils.prediction_store import PredictionWriter, clear_predictions
+from utils.resources import plan_resources
+
+
+def list_videos(paths):
+    """mp4 files given directly, found in the given directories or listed one per line in .txt files."""
+    video_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            video_paths.extend(sorted(glob.glob(os.path.join(path, '*.mp4'))))
+        elif path.endswith('.txt'):
+            with open(path) as f:
+                video_paths.extend(line.strip() for line in f if line.strip())
+        else:
+            video_paths.append(path)
+    return video_paths
+
+
+def no_collate(sample):
+    return sample
+
+
+class StageStats(object):
+    """Busy time, videos and frames of each pipeline stage."""
+
+    def __init__(self, stages):
+        self.stats = {stage: {'time': 0.0, 'videos': 0, 'frames': 0} for stage in stages}
+
+    def update(self, stage, seconds, frames, videos=1):
+        self.stats[stage]['time'] += seconds
+        self.stats[stage]['videos'] += videos
+        self.stats[stage]['frames'] += frames
+
+    def summary(self, wall_time):
+        rows = []
+        for stage, stat in self.stats.items():
+            rows.append([stage, stat['videos'], stat['frames'], stat['time'],
+                         stat['frames'] / max(stat['time'], 1e-9), stat['frames'] / max(wall_time, 1e-9)])
+        headers = ['Stage', 'Videos', 'Frames', 'Busy (s)', 'Frames/busy s', 'Frames/wall s']
+        return tabulate(rows, headers=headers, floatfmt='.2f')
+
+
+def decode_stage(data_loader, stats, fps_dict):
+    """Videos decoded by the DataLoader workers, prefetching at most num_workers x prefetch_factor videos."""
+    for sample in data_loader:
+        stats.update('decode', sample['decode_time'], len(sample['frame_indices']))
+        fps_dict[sample['vid']] = sample['fps']
+        yield sample['vid'], sample['frame_indices'], sample['inputs']
+
+
+def postprocess_stage(cfg, results_queue, fps_dict, stats, results, pred_writer, errors):
+    """
+    Boundary extraction and writing, fed by the model stage through a bounded queue until None.
+    An exception is stored in `errors` for the main thread, which stops feeding the queue and re-raises it.
+    """
+    try:
+        while True:
+            item = results_queue.get()
+            if item is None:
+                break
+            vid, frame_indices, scores = item
+            start = time.time()
+            det_t = get_idx_from_score_by_threshold(threshold=cfg.TEST.THRESHOLD,
+                                                    seq_indices=frame_indices,
+                                                    seq_scores=scores,
+                                                    mode=cfg.TEST.BOUNDARY_MODE,
+                                                    smooth=cfg.TEST.SMOOTH_WINDOW,
+                                                    nms_window=cfg.TEST.NMS_WINDOW) / fps_dict[vid]
+            results[vid] = det_t.tolist()
+            if pred_writer is not None:
+                pred_writer.add([vid], [frame_indices], [scores])
+            stats.update('postprocess', time.time() - start, len(frame_indices))
+    except BaseException as e:
+        errors.append(e)
+
+
+def put_result(results_queue, item, consumer, errors, timeout=1.0):
+    """Puts `item` while the postprocess thread is alive, a failed one would never make room in the queue."""
+    while True:
+        if len(errors) > 0:
+            raise errors[0]
+        if not consumer.is_alive():
+            return
+        try:
+            results_queue.put(item, timeout=timeout)
+            return
+        except queue.Full:
+            pass
+
+
+def load_model(cfg, resume, device):
     model = build_model(cfg)
     model = model.to(device)
     model.eval()
 
-    if args.resume:
-        state_dict = torch.load(args.resume, map_location='cpu')
+    if resume:
+        state_dict = torch.load(resume, map_location='cpu')
         model.load_state_dict(state_dict['model'])
         start_epoch = state_dict['epoch']
         if is_main_process():
-            print('Loaded from {}, Epoch: {}'.format(args.resume, start_epoch), flush=True)
+            print('Loaded from {}, Epoch: {}'.format(resume, start_epoch), flush=True)
+
+    if cfg.TEST.OPTIMIZE:
+        # parity checked on one random GOP
+        size = cfg.INPUT.IMAGE_SIZE
+        example_inputs = {
+            'imgs': torch.randn(1, GOP, 3, size, size, device=device),
+            'mv': torch.randn(1, GOP, 2, size, size, device=device),
+            'res': torch.randn(1, GOP, 3, size, size, device=device),
+            'frame_mask': torch.ones(1, GOP, device=device),
+        }
+        model = optimize_for_inference(model, example_inputs)
+
+    model = apply_cpu_profile(cfg, model, device)
+    if device.type == 'cpu' and cfg.CPU.BF16:
+        if not isinstance(model, InferenceGEBDModel):
+            model = InferenceGEBDModel(model)
+        model.auto_cast = build_autocast(cfg, device)
+    return model
+
+
+@torch.no_grad()
+def main(cfg, args):
+    device = torch.device(args.device)
+    num_workers, worker_init_fn = args.num_workers, None
+    if device.type == 'cpu' and cfg.CPU.PLAN_RESOURCES:
+        plan = plan_resources(cfg, num_workers=args.num_workers, decode_mp4=True)
+        plan.apply_main()
+        num_workers, worker_init_fn = plan.num_workers, plan.init_worker
+        print(plan, flush=True)
+    model = load_model(cfg, args.resume, device)
 
     if is_main_process():
         print(model)
 
-    results = []
-    for frames_dir in glob.glob(os.path.join(args.frames_dir, '*')):
-        if not os.path.isdir(frames_dir):
-            continue
-
-        imgs, frame_indices = load_frames(frames_dir)
-
-        inputs = {'imgs': imgs.to(device)[None]}
-
-        scores = model(inputs)[0][0].cpu().numpy()
-        threshold = 0.5
-        cap = cv2.VideoCapture(frames_dir + '.mp4')
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        print(imgs.shape, fps)
-        det_t = np.array(get_idx_from_score_by_threshold(threshold=threshold,
-                                                         seq_indices=frame_indices,
-                                                         seq_scores=scores)) / fps
-        # with open(frames_dir + '.pkl', 'wb') as f:
-        #     pickle.dump(det_t, f)
-        results.append(
-            '{}: {}'.format(frames_dir.split('/')[-1] + '.mp4', ', '.join(map(lambda x: str(round(x, 2)), det_t)))
-        )
-        np.save(os.path.basename(frames_dir), scores)
-    with open('CLIPSHOTS_RGB.txt', 'w') as f:
-        f.write('\n'.join(results))
+    # whole videos in windows of CHUNK_SIZE frames, SEQUENCE_LENGTH (the training length) if chunking is off
+    chunk_size = cfg.TEST.CHUNK_SIZE if cfg.TEST.CHUNK_SIZE > 0 else cfg.INPUT.SEQUENCE_LENGTH
+    detector = ChunkedGEBDDetector(model, chunk_size, cfg.TEST.CHUNK_OVERLAP, cfg.SOLVER.BATCH_SIZE, cfg.TEST.CHUNK_BLEND)
+    pred_writer = None
+    if args.pred_store:
+        # with an explicit --pred-rank the store is shared with independent processes, cleared by their launcher
+        if args.pred_rank is None:
+            if is_main_process():
+                clear_predictions(args.pred_store)
+            synchronize()
+        pred_writer = PredictionWriter(args.pred_store, rank=args.pred_rank)
+
+    # decode (DataLoader worker processes) -> window batching + model (this thread) -> postprocess (thread),
+    # joined by bounded queues so that every stage keeps working while the others do
+    # under torchrun every rank scores its own share of the videos, rank 0 writes the boundaries of all of them
+    video_paths = list_videos(args.videos)[get_rank()::get_world_size()]
+    loader_kwargs = {'prefetch_factor': args.prefetch} if num_workers > 0 else {}
+    data_loader = DataLoader(VideoFileDataset(video_paths, cfg.INPUT.DOWNSAMPLE),
+                             batch_size=None,
+                             collate_fn=no_collate,
+                             num_workers=num_workers,
+                             worker_init_fn=worker_init_fn,
+                             **loader_kwargs)
+    stats = StageStats(['decode', 'model', 'postprocess'])
+    fps_dict = {}
+    results = {}
+    results_queue = queue.Queue(maxsize=args.queue_size)
+    errors = []
+    postprocess_thread = threading.Thread(target=postprocess_stage,
+                                          args=(cfg, results_queue, fps_dict, stats, results, pred_writer, errors))
+    postprocess_thread.start()
+
+    start_time = time.time()
+    try:
+        for num_scored, (vid, frame_indices, scores) in enumerate(detector(decode_stage(data_loader, stats, fps_dict)), 1):
+            put_result(results_queue, (vid, frame_indices, scores), postprocess_thread, errors)
+            if num_scored % args.log_interval == 0:
+                print('{}/{} videos, {:.2f} videos/s'.format(num_scored, len(video_paths), num_scored / (time.time() - start_time)), flush=True)
+    finally:
+        # the error of a failed postprocess thread is raised below, not while stopping it
+        put_result(results_queue, None, postprocess_thread, [])
+        postprocess_thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    wall_time = time.time() - start_time
+    stats.update('model', detector.time_cost['model'], stats.stats['decode']['frames'], videos=len(results))
+
+    if pred_writer is not None:
+        pred_writer.close()
+    rank_prefix = f'Rank {get_rank()}: ' if get_world_size() > 1 else ''
+    print(rank_prefix + '{} videos in {:.2f}s, {:.2f} videos/s'.format(len(results), wall_time, len(results) / max(wall_time, 1e-9)))
+    print(stats.summary(wall_time), flush=True)
+
+    all_results = {}
+    for rank_results in all_gather(results):
+        all_results.update(rank_results)
+    if is_main_process():
+        with open(args.output, 'w') as f:
+            json.dump(all_results, f)
+        print(f'Saved boundaries of {len(all_results)} videos to {args.output}.')
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description='Boundary timestamps of mp4 videos, decoded in the compressed domain (I-frame RGB + P-frame MV/residual).')
     parser.add_argument("--config-file", help="path to config file", type=str)
     parser.add_argument("--local_rank", type=int, default=0)
+    parser.add_argument("--dist-backend", type=str, default='', help='nccl on cuda and gloo on cpu by default')
     parser.add_argument("--resume", type=str)
-    parser.add_argument("--frames_dir", type=str)
+    parser.add_argument("--videos", type=str, nargs='+', required=True, help='mp4 files, directories of mp4 files or .txt lists of mp4 files')
+    parser.add_argument("--output", type=str, default='GEBD_pred.json', help='{video: [boundary seconds]}')
+    parser.add_argument("--pred-store", type=str, default='', help='also save the per-frame scores to this folder, read with PredictionReader')
+    parser.add_argument("--pred-rank", type=int, default=None, help='shard name of this process in --pred-store, the distributed rank by default')
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count(), help='decoding processes')
+    parser.add_argument("--prefetch", type=int, default=2, help='decoded videos queued per decoding process')
+    parser.add_argument("--queue-size", type=int, default=16, help='scored videos queued for postprocessing')
+    parser.add_argument("--log-interval", type=int, default=100)
     parser.add_argument("opts", help="Modify config options using the command-line", default=None, nargs=argparse.REMAINDER)
 
     args = parser.parse_args()
-    local_rank = args.local_rank
-    num_gpus = int(os.environ["WORLD_SIZE"]) if "WORLD_SIZE" in os.environ else 1
-    args.distributed = num_gpus > 1
-    args.num_gpus = num_gpus
-
-    if torch.cuda.is_available():
+    args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if args.device == 'cuda':
         torch.backends.cudnn.benchmark = True
-        if args.distributed:
-            torch.cuda.set_device(args.local_rank)
-            torch.distributed.init_process_group(backend="nccl", init_method="env://")
-            dist.barrier()
+    init_distributed(args)
 
     cfg.merge_from_file(args.config_file)
     cfg.merge_from_list(args.opts)
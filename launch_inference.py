@@ -0,0 +1,139 @@
+import argparse
+import heapq
+import json
+import os
+import subprocess
+import sys
+import time
+
+from tabulate import tabulate
+
+from inference import list_videos
+from utils.prediction_store import clear_predictions
+from utils.resources import available_cores
+
+
+def video_lengths(video_paths, index_path=''):
+    """
+    Number of frames of every video, from the metadata index {path: num_frames} at `index_path` (a json file);
+    videos missing from the index are probed from their container header and added to it.
+    """
+    import cv2
+
+    index = {}
+    if index_path and os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    missing = [path for path in video_paths if path not in index]
+    for path in missing:
+        cap = cv2.VideoCapture(path)
+        index[path] = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+    if index_path and len(missing) > 0:
+        with open(index_path, 'w') as f:
+            json.dump(index, f)
+    return [index[path] for path in video_paths]
+
+
+def balance_shards(video_paths, lengths, num_shards):
+    """Longest videos first, each to the shard with the fewest frames so far. Returns the shards and their frames."""
+    heap = [(0, i) for i in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    loads = [0] * num_shards
+    for length, path in sorted(zip(lengths, video_paths), reverse=True):
+        load, i = heapq.heappop(heap)
+        shards[i].append(path)
+        loads[i] = load + length
+        heapq.heappush(heap, (loads[i], i))
+    return shards, loads
+
+
+def main(args):
+    video_paths = list_videos(args.videos)
+    lengths = video_lengths(video_paths, args.index)
+    shards, loads = balance_shards(video_paths, lengths, args.num_procs)
+
+    cores = available_cores()
+    cores_per_proc = max(len(cores) // args.num_procs, 1)
+    # the decoding workers of a process share its cores with the compute threads
+    threads = args.threads if args.threads > 0 else max(cores_per_proc - args.num_workers, 1)
+    print(f'{len(video_paths)} videos ({sum(lengths)} frames) in {args.num_procs} processes, '
+          f'{threads} compute threads + {args.num_workers} decoding workers each, {len(cores)} cores.', flush=True)
+
+    shard_dir = os.path.join(args.work_dir, 'shards')
+    os.makedirs(shard_dir, exist_ok=True)
+    if args.pred_store:
+        # the processes only replace their own shards, those of a previous run with more processes would be merged
+        clear_predictions(args.pred_store)
+    procs = []
+    start_time = time.time()
+    for i, shard in enumerate(shards):
+        list_path = os.path.join(shard_dir, f'shard{i}.txt')
+        with open(list_path, 'w') as f:
+            f.write('\n'.join(shard) + '\n')
+        cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inference.py'),
+               '--config-file', args.config_file,
+               '--videos', list_path,
+               '--output', os.path.join(shard_dir, f'shard{i}.json'),
+               '--num-workers', str(args.num_workers),
+               '--log-interval', str(args.log_interval)]
+        if args.resume:
+            cmd += ['--resume', args.resume]
+        if args.pred_store:
+            cmd += ['--pred-store', args.pred_store, '--pred-rank', str(i)]
+        cmd += ['CPU.NUM_THREADS', str(threads)] + args.opts
+
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads), CUDA_VISIBLE_DEVICES='')
+        proc_cores = [cores[(i * cores_per_proc + j) % len(cores)] for j in range(cores_per_proc)]
+        preexec_fn = (lambda proc_cores=proc_cores: os.sched_setaffinity(0, proc_cores)) if args.pin else None
+        log = open(os.path.join(shard_dir, f'shard{i}.log'), 'w')
+        procs.append((subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT, preexec_fn=preexec_fn), log))
+
+    end_times = [None] * len(procs)
+    while any(end_time is None for end_time in end_times):
+        for i, (proc, log) in enumerate(procs):
+            if end_times[i] is None and proc.poll() is not None:
+                end_times[i] = time.time()
+                log.close()
+                print(f'Shard {i} finished with code {proc.returncode} after {end_times[i] - start_time:.1f}s.', flush=True)
+        time.sleep(0.5)
+    wall_time = time.time() - start_time
+
+    failed = [i for i, (proc, _) in enumerate(procs) if proc.returncode != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f'Shards {failed} failed, see their logs in {shard_dir}.')
+
+    results = {}
+    rows = []
+    for i, shard in enumerate(shards):
+        with open(os.path.join(shard_dir, f'shard{i}.json')) as f:
+            results.update(json.load(f))
+        seconds = end_times[i] - start_time
+        rows.append([i, len(shard), loads[i], seconds, len(shard) / max(seconds, 1e-9)])
+    with open(args.output, 'w') as f:
+        json.dump(results, f)
+
+    print(tabulate(rows, headers=['Shard', 'Videos', 'Frames', 'Seconds', 'Videos/s'], floatfmt='.2f'))
+    print(f'Saved boundaries of {len(results)} videos to {args.output}.')
+    if args.pred_store:
+        print(f'Per-frame scores of all shards in {args.pred_store}.')
+    print('{} videos in {:.2f}s, {:.2f} videos/s'.format(len(results), wall_time, len(results) / max(wall_time, 1e-9)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='inference.py in several CPU processes, each with its own thread budget and a shard of the videos balanced by length.')
+    parser.add_argument("--config-file", help="path to config file", type=str)
+    parser.add_argument("--resume", type=str)
+    parser.add_argument("--videos", type=str, nargs='+', required=True, help='mp4 files, directories of mp4 files or .txt lists of mp4 files')
+    parser.add_argument("--index", type=str, default='', help='json {video path: num_frames} used to balance the shards, missing videos are probed and added')
+    parser.add_argument("--num-procs", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=0, help='compute threads per process, 0: cores / num-procs - num-workers')
+    parser.add_argument("--num-workers", type=int, default=1, help='decoding workers per process')
+    parser.add_argument("--pin", action='store_true', help='bind every process (and its workers) to its own cores')
+    parser.add_argument("--work-dir", type=str, default='inference_shards', help='shard lists, outputs and logs')
+    parser.add_argument("--output", type=str, default='GEBD_pred.json', help='merged {video: [boundary seconds]}')
+    parser.add_argument("--pred-store", type=str, default='', help='per-frame scores of all shards, read with PredictionReader')
+    parser.add_argument("--log-interval", type=int, default=100)
+    parser.add_argument("opts", help="Modify config options of every process using the command-line", default=None, nargs=argparse.REMAINDER)
+    main(parser.parse_args())
@@ -5,12 +5,15 @@ from .baseline_model import GEBDModel
 from .compressed_model import CompressedGEBDModel
 
 from .e2e_compressed_model_tip import E2ECompressedGEBDModel
+from .streaming import StreamingGEBDDetector
+from .chunked import ChunkedGEBDDetector
+from .optimize import optimize_for_inference
 
 
-def build_model(cfg):
+def build_model(cfg, sync_bn=None):
     model = E2ECompressedGEBDModel(cfg)
 
-    if cfg.MODEL.SYNC_BN:
+    if cfg.MODEL.SYNC_BN if sync_bn is None else sync_bn:
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
 
     return model
@@ -0,0 +1,168 @@
+import time
+from collections import deque
+from contextlib import suppress
+
+import numpy as np
+import torch
+
+from .e2e_compressed_model_tip import GOP
+
+
+def chunk_starts(num_frames, chunk_size, overlap):
+    """Start positions of the windows covering `num_frames` frames, consecutive windows share `overlap` frames."""
+    stride = chunk_size - overlap
+    return list(range(0, max(num_frames - overlap, 1), stride))
+
+
+def blend_weights(chunk_size, overlap, blend='linear'):
+    """
+    Per-position weight of a window's scores when averaging overlapping windows.
+    'mean': uniform, 'linear': ramps down over the `overlap` frames at each end, so frames near a window border
+    (with less temporal context) count less.
+    """
+    if blend == 'mean' or overlap == 0:
+        return np.ones((chunk_size,), dtype=np.float64)
+    elif blend == 'linear':
+        positions = np.arange(chunk_size)
+        ramp = np.minimum(positions + 1, chunk_size - positions) / (overlap + 1)
+        return np.minimum(ramp, 1.0)
+    raise NotImplementedError(blend)
+
+
+# inputs only held by one type of frame when the video comes with an 'i_frame_mask', see `load_compressed_video`
+I_FRAME_KEYS = ('imgs',)
+P_FRAME_KEYS = ('mv', 'res')
+
+
+def check_i_frame_slots(inputs):
+    """The model reads the I-frame RGB at every GOP-th frame of a window, the I-frames of the video must be there."""
+    i_frame_mask = inputs.get('i_frame_mask')
+    if i_frame_mask is not None:
+        assert torch.equal(i_frame_mask, torch.arange(len(i_frame_mask)) % GOP == 0), \
+            'The I-frames are not every GOP={}-th frame, decode with INPUT.DOWNSAMPLE x GOP = 12 and no dynamic downsample.'.format(GOP)
+
+
+def chunk_window(inputs, start, chunk_size, keys=('imgs', 'mv', 'res', 'frame_mask')):
+    """
+    (chunk_size, ...) slices of every input, zero padded past the end of the video (frame_mask 0).
+    With an 'i_frame_mask' (T,), imgs only holds the I-frames and mv/res the other frames, they are expanded
+    to the frames of the window with zeros elsewhere.
+    """
+    i_frame_mask = inputs.get('i_frame_mask')
+    if i_frame_mask is not None:
+        window_mask = i_frame_mask[start:start + chunk_size]
+        num_i_frames = int(i_frame_mask[:start].sum())
+        rows = {key: (num_i_frames, window_mask) for key in I_FRAME_KEYS}
+        rows.update({key: (start - num_i_frames, ~window_mask) for key in P_FRAME_KEYS})
+
+    window = {}
+    for key in keys:
+        if i_frame_mask is not None and key in rows:
+            offset, frame_mask = rows[key]
+            values = inputs[key][offset:offset + int(frame_mask.sum())]
+            x = values.new_zeros((len(frame_mask),) + values.shape[1:])
+            x[frame_mask] = values
+        else:
+            x = inputs[key][start:start + chunk_size]
+        if x.shape[0] < chunk_size:
+            padding = x.new_zeros((chunk_size - x.shape[0],) + x.shape[1:])
+            x = torch.cat([x, padding], dim=0)
+        window[key] = x
+    return window
+
+
+def stitch_scores(num_frames, starts, window_scores, weights):
+    """Weighted average of the (chunk_size,) scores of the windows starting at `starts`, (num_frames,)."""
+    score_sum = np.zeros((num_frames,), dtype=np.float64)
+    weight_sum = np.zeros((num_frames,), dtype=np.float64)
+    for start, scores in zip(starts, window_scores):
+        end = min(start + len(weights), num_frames)
+        score_sum[start:end] += weights[:end - start] * scores[:end - start]
+        weight_sum[start:end] += weights[:end - start]
+    return score_sum / weight_sum
+
+
+class ChunkedGEBDDetector(object):
+    """
+    Inference over whole videos of any length with an E2ECompressedGEBDModel.
+
+    Every video is cut into windows of `chunk_size` frames overlapping by `overlap` frames (the last one is padded
+    like the dataset pads short videos, frame_mask 0), windows of consecutive videos are batched together
+    `batch_size` at a time and the scores of overlapping windows are averaged with `blend_weights`. Memory only
+    depends on chunk_size x batch_size, not on the video length.
+
+    Usage:
+        detector = ChunkedGEBDDetector(model, chunk_size=100, overlap=20, batch_size=4)
+        for vid, frame_indices, scores in detector(videos):
+            ...
+    where `videos` yields (vid, frame_indices (T,), inputs) and inputs holds (T, ...) tensors imgs, mv, res, frame_mask,
+    or the I-frame/P-frame only inputs of `load_compressed_video` (see `chunk_window`).
+    """
+
+    keys = ('imgs', 'mv', 'res', 'frame_mask')
+
+    def __init__(self, model, chunk_size=100, overlap=20, batch_size=4, blend='linear', auto_cast=suppress):
+        assert 0 <= overlap < chunk_size, 'overlap must be smaller than chunk_size.'
+        assert chunk_size % GOP == 0 and (chunk_size - overlap) % GOP == 0, \
+            'chunk_size and chunk_size - overlap must be multiples of GOP={} to keep I-frames in place.'.format(GOP)
+        self.model = model.eval()
+        self.device = next(model.parameters()).device
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.weights = blend_weights(chunk_size, overlap, blend)
+        self.auto_cast = auto_cast
+        self.time_cost = {'model': 0.0, 'backbone': 0.0, 'head': 0.0}
+
+    def __call__(self, videos):
+        pending = deque()  # (video, start) of the windows not scored yet
+        videos = iter(videos)
+        exhausted = False
+        while not exhausted or len(pending) > 0:
+            while not exhausted and len(pending) < self.batch_size:
+                try:
+                    vid, frame_indices, inputs = next(videos)
+                except StopIteration:
+                    exhausted = True
+                    break
+                check_i_frame_slots(inputs)
+                num_frames = len(frame_indices)
+                starts = chunk_starts(num_frames, self.chunk_size, self.overlap)
+                video = {
+                    'vid': vid,
+                    'frame_indices': np.asarray(frame_indices),
+                    'inputs': inputs,
+                    'score_sum': np.zeros((num_frames,), dtype=np.float64),
+                    'weight_sum': np.zeros((num_frames,), dtype=np.float64),
+                    'remaining': len(starts),
+                }
+                pending.extend((video, start) for start in starts)
+
+            windows = [pending.popleft() for _ in range(min(self.batch_size, len(pending)))]
+            if len(windows) == 0:
+                continue
+            yield from self._score(windows)
+
+    @torch.no_grad()
+    def _score(self, windows):
+        batch = [chunk_window(video['inputs'], start, self.chunk_size, self.keys) for video, start in windows]
+        batch = {key: torch.stack([window[key] for window in batch], dim=0).to(self.device) for key in self.keys}
+
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+        start_time = time.time()
+        with self.auto_cast():
+            scores, time_cost = self.model(batch)  # (b, chunk_size)
+        scores = scores.float().cpu().numpy()
+        self.time_cost['model'] += time.time() - start_time
+        self.time_cost['backbone'] += time_cost['backbone']
+        self.time_cost['head'] += time_cost['head']
+
+        for (video, start), window_scores in zip(windows, scores):
+            end = min(start + self.chunk_size, len(video['frame_indices']))
+            weights = self.weights[:end - start]
+            video['score_sum'][start:end] += weights * window_scores[:end - start]
+            video['weight_sum'][start:end] += weights
+            video['remaining'] -= 1
+            if video['remaining'] == 0:
+                yield video['vid'], video['frame_indices'], video['score_sum'] / video['weight_sum']
@@ -11,6 +11,9 @@ _C.MODEL.BACKBONE = CN()
 _C.MODEL.BACKBONE.NAME = 'resnet50'
 _C.MODEL.DIM = 256
 _C.MODEL.BACKBONE.SIDE_DATA_NAME = 'resnet18'
+# ResNet stages frozen and run without grad: 0 none, 1 the stem (conv1 + bn1), 2 the stem and layer1, ..., 5 all
+_C.MODEL.BACKBONE.FREEZE_AT = 1  # I-frame backbone
+_C.MODEL.BACKBONE.SIDE_DATA_FREEZE_AT = 0  # mv / res backbones, weights only: their input BatchNorm and the mv conv1 (not pretrained) stay trained, so they still run with grad
 _C.MODEL.TEMPORAL_MODEL = 'transformer'  # Transformer or GRU
 _C.MODEL.USE_GROUP_SIMILARITY = True  # Transformer or GRU
 
@@ -21,6 +24,17 @@ _C.MODEL.USE_RESIDUAL = True
 _C.MODEL.USE_MV_AS_DECONV_PARAMS = True
 _C.MODEL.KERNEL_SIZE = 8
 
+# activation checkpointing: the activations of these stages are recomputed in backward instead of kept
+_C.MODEL.CHECKPOINT = CN()
+_C.MODEL.CHECKPOINT.BACKBONE = []  # ResNet stages of the I-frame backbone, e.g. ['layer1', 'layer2']
+_C.MODEL.CHECKPOINT.SIDE_DATA = []  # ResNet stages of the mv / res backbones
+_C.MODEL.CHECKPOINT.ESTIMATORS = False  # EstimatorDenseNetTiny channel / spatial weights of the P-frame fusion
+_C.MODEL.CHECKPOINT.SIMILARITY = False  # GroupSimilarity.fcn, its BatchNorm running stats are updated twice per step
+
+# extract_features outputs of the train I-frames written by precompute_i_features.py: the I-frame backbone and
+# embedding are fixed to the weights stored with them and not run during training (validation still runs them)
+_C.MODEL.I_FEATURE_STORE = ''
+
 # -----------------------------------------------------------------------------
 # Dataset
 # -----------------------------------------------------------------------------
@@ -62,7 +76,32 @@ _C.SOLVER.OPTIMIZER = 'SGD'
 # ---------------------------------------------------------------------------- #
 _C.TEST = CN()
 _C.TEST.THRESHOLD = 0.5
-_C.TEST.PRED_FILE = ''  # precomputed predictions
+_C.TEST.PRED_FILE = ''  # precomputed predictions, a model_pred_dict_*.pkl or a TEST.PRED_STORE folder
+_C.TEST.PRED_STORE = ''  # stream the predictions to .npz shards in this folder instead of pickling model_pred_dict_*.pkl
 _C.TEST.RELDIS_THRESHOLD = 0.05
+_C.TEST.BOUNDARY_MODE = 'center'  # 'center' of each run of scores >= THRESHOLD, or NMS'd score 'peak's
+_C.TEST.SMOOTH_WINDOW = 1  # moving average over the scores before boundary extraction, 1 disables it
+_C.TEST.NMS_WINDOW = 5  # frames suppressed around each peak for BOUNDARY_MODE 'peak'
+_C.TEST.DISTRIBUTED_EVAL = False  # every rank matches its own videos, only TP/num_pos/num_det are reduced, no pred file is saved
+_C.TEST.GATHER_SCORE_DTYPE = 'float32'  # dtype of the scores sent to rank 0 during distributed validation, float16 halves the traffic
+_C.TEST.EVAL_WORKERS = 0  # processes for boundary matching in eval_f1, 0 runs it in the main process
+_C.TEST.CHUNK_SIZE = 0  # > 0: score every INPUT.DOWNSAMPLE-th frame of whole videos in windows of CHUNK_SIZE frames, each video is still decoded whole by the loader
+_C.TEST.CHUNK_OVERLAP = 20  # frames shared by consecutive windows, CHUNK_SIZE - CHUNK_OVERLAP must be a multiple of the GOP
+_C.TEST.CHUNK_BLEND = 'linear'  # weighting of overlapping window scores, 'linear' ramps or 'mean'
+_C.TEST.FEATURE_STORE = ''  # cached per-frame features (input of SPoS), one sub-folder per checkpoint and split
+_C.TEST.DUMP_FEATURES = False  # write the features to TEST.FEATURE_STORE during validation
+_C.TEST.HEAD_ONLY = False  # score from TEST.FEATURE_STORE, running only SPoS + classifier
+_C.TEST.OPTIMIZE = False  # inference.py / serve.py / export.py: fold the batch norms into the convs (optimize_for_inference)
+
+# execution profile when running on cpu (--device cpu), see modeling/cpu_profile.py
+_C.CPU = CN()
+_C.CPU.CHANNELS_LAST = False  # NHWC conv weights / activations, the layout oneDNN convs are fastest with
+_C.CPU.BF16 = False  # torch.autocast('cpu', bfloat16) for training and inference, only if the CPU supports bf16 natively
+_C.CPU.NUM_THREADS = 0  # torch intra-op threads, 0 keeps the default (or leaves it to the resource plan)
+_C.CPU.PLAN_RESOURCES = False  # split the cores between the main process and the DataLoader workers, see utils/resources.py
+_C.CPU.DATA_CORES_FRACTION = 0.5  # share of the cores given to the workers when NUM_THREADS is 0
+_C.CPU.WORKER_THREADS = 1  # cv2 / torch / OpenMP threads of each worker
+_C.CPU.DECODER_THREADS = 1  # ffmpeg threads of each worker's video decoder, inference.py only (mp4 decoding)
+_C.CPU.PIN_AFFINITY = False  # bind the main process and every worker to their own cores
 
 _C.OUTPUT_DIR = 'output'
@@ -0,0 +1,41 @@
+from contextlib import suppress
+from functools import partial
+
+import torch
+
+from utils.distribute import is_main_process
+
+
+def bf16_supported():
+    """Whether oneDNN runs bf16 natively on this CPU (AVX512-BF16 / AMX), otherwise bf16 autocast is slower than fp32."""
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def build_autocast(cfg, device):
+    """
+    Context manager factory for the forward passes: fp16 autocast on cuda (SOLVER.AMPE), bf16 autocast on cpu
+    (CPU.BF16) when the CPU supports it, no autocast otherwise.
+    """
+    if device.type == 'cuda':
+        return torch.cuda.amp.autocast if cfg.SOLVER.AMPE else suppress
+    if cfg.CPU.BF16:
+        if bf16_supported():
+            return partial(torch.autocast, 'cpu', dtype=torch.bfloat16)
+        if is_main_process():
+            print('CPU.BF16 ignored, this CPU has no native bf16 support.', flush=True)
+    return suppress
+
+
+def apply_cpu_profile(cfg, model, device):
+    """Intra-op threads (CPU.NUM_THREADS) and channels_last conv weights (CPU.CHANNELS_LAST) on cpu, in place."""
+    if device.type != 'cpu':
+        return model
+    if cfg.CPU.NUM_THREADS > 0:
+        torch.set_num_threads(cfg.CPU.NUM_THREADS)
+    if cfg.CPU.CHANNELS_LAST:
+        # the convs follow the memory format of their weights, activations stay NHWC through the ResNets
+        model = model.to(memory_format=torch.channels_last)
+    return model
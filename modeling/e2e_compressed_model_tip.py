@@ -6,6 +6,7 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 from torch.nn import Module
+from torch.utils.checkpoint import checkpoint
 from torchvision import models
 from torchvision.ops import DeformConv2d, FrozenBatchNorm2d
 from transformers import BertConfig, BertLayer
@@ -16,6 +17,59 @@ GOP = 4
 INDEX = 0
 
 
+def checkpoint_stage(module, x, enabled):
+    """
+    module(x), its activations recomputed in backward instead of kept when `enabled` and training with grad.
+    The recompute normalises with the same batch statistics, the running statistics it would update a second time
+    are put back.
+    """
+    if not (enabled and module.training and torch.is_grad_enabled()):
+        return module(x)
+
+    running_stats = [buffer for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats
+                     for buffer in (m.running_mean, m.running_var, m.num_batches_tracked) if buffer is not None]
+    calls = {'forward': 0}
+
+    def run(x):
+        calls['forward'] += 1
+        if calls['forward'] == 1 or len(running_stats) == 0:
+            return module(x)
+        saved = [buffer.clone() for buffer in running_stats]
+        try:
+            return module(x)
+        finally:
+            # also when the recompute stops early, once the tensors backward needs are recomputed
+            with torch.no_grad():
+                for buffer, value in zip(running_stats, saved):
+                    buffer.copy_(value)
+
+    return checkpoint(run, x, use_reentrant=False)
+
+
+def frozen_resnet_modules(backbone, freeze_at):
+    """Modules of the first `freeze_at` stages of a torchvision ResNet: 1 the stem (conv1 + bn1), 2 also layer1, ..."""
+    if freeze_at <= 0:
+        return []
+    return [backbone.conv1, backbone.bn1] + [getattr(backbone, f'layer{i}') for i in range(1, min(freeze_at, 5))]
+
+
+def forward_resnet(backbone, x, freeze_at=0, checkpoint_layers=()):
+    """
+    Stem and layer1-4 of a torchvision ResNet. The first `freeze_at` stages run without grad, so that none of their
+    activations are kept; the layers in `checkpoint_layers` are recomputed in backward.
+    """
+    grad_enabled = torch.is_grad_enabled()
+    with torch.set_grad_enabled(grad_enabled and freeze_at < 1):
+        x = backbone.conv1(x)
+        x = backbone.bn1(x)
+        x = backbone.relu(x)
+        x = backbone.maxpool(x)
+    for i in range(1, 5):
+        with torch.set_grad_enabled(grad_enabled and freeze_at < i + 1):
+            x = checkpoint_stage(getattr(backbone, f'layer{i}'), x, f'layer{i}' in checkpoint_layers)
+    return x
+
+
 def prepare_gaussian_targets(targets, sigma=1):
     gaussian_targets = []
     for batch_idx in range(targets.shape[0]):
@@ -128,6 +182,7 @@ class SidedataModel(Module):
         super().__init__()
         assert mode in ['res', 'mv', 'rgb']
         assert cfg.INPUT.USE_SIDE_DATA
+        self.mode = mode
         self.backbone = getattr(models, cfg.MODEL.BACKBONE.SIDE_DATA_NAME)(pretrained=True, norm_layer=FrozenBatchNorm2d)
         self.out_features = self.backbone.fc.in_features
         del self.backbone.fc
@@ -144,23 +199,31 @@ class SidedataModel(Module):
 
         # self.fpn = FPN([64, 128, 256, 512], dim)
         self.embedding = nn.Conv2d(512, dim, 3, 1, 1)
+        self.checkpoint_layers = set(cfg.MODEL.CHECKPOINT.SIDE_DATA)
+
+        self.freeze_at = cfg.MODEL.BACKBONE.SIDE_DATA_FREEZE_AT
+        # the input BatchNorm and the mv conv1 are not pretrained, they are never frozen and the frozen stages after
+        # them still backpropagate to them: freezing only stops training weights, no activation is saved
+        for param in itertools.chain.from_iterable(module.parameters() for module in self.frozen_modules()):
+            param.requires_grad = False
+
+    def frozen_modules(self):
+        """The pretrained modules of the first FREEZE_AT ResNet stages."""
+        modules = frozen_resnet_modules(self.backbone, self.freeze_at)
+        if self.mode == 'mv':
+            modules = [module for module in modules if module is not self.backbone.conv1]
+        return modules
+
+    def train(self, mode=True):
+        super().train(mode)
+        # frozen stages keep their running statistics
+        for module in self.frozen_modules():
+            module.eval()
+        return self
 
     def extract_features(self, x):
         x = self.bn(x)
-        x = self.backbone.conv1(x)
-        x = self.backbone.bn1(x)
-        x = self.backbone.relu(x)
-        x = self.backbone.maxpool(x)
-
-        outputs = []
-        x = self.backbone.layer1(x)  # 64, 56, 56
-        outputs.append(x)
-        x = self.backbone.layer2(x)  # 128, 28, 28
-        outputs.append(x)
-        x = self.backbone.layer3(x)  # 256, 14, 14
-        outputs.append(x)
-        x = self.backbone.layer4(x)  # 512, 7, 7
-        outputs.append(x)
+        x = forward_resnet(self.backbone, x, checkpoint_layers=self.checkpoint_layers)  # 512, 7, 7
 
         # outputs = self.fpn(outputs)[1]
         outputs = self.embedding(x)
@@ -216,6 +279,7 @@ class UpsampleUpdatingModel2(Module):
 
         self.spatial_module = EstimatorDenseNetTiny(in_dim + dim * 2, 1)
         self.channel_module = EstimatorDenseNetTiny(in_dim + dim * 2, dim)
+        self.checkpoint_estimators = cfg.MODEL.CHECKPOINT.ESTIMATORS
 
         # self.motion_convs = nn.Sequential(
         #     nn.Conv2d(dim, dim, kernel_size=3, padding=1),
@@ -226,36 +290,48 @@ class UpsampleUpdatingModel2(Module):
         #     nn.ReLU(inplace=True)
         # )
 
-    def forward(self, imgs, i_features, p_motions):
+    def forward(self, frames, i_features, p_motions):
         """
         Args:
-            imgs: (4, 100, 3, 224, 224)
+            frames: (4, 100, ...) any per-frame input of the windows, for their batch size and length
             i_features: (100, 256, 7, 7)
             p_motions: (100, 3, 2, 224, 224)
         Returns:
         """
-        B = imgs.shape[0]
-        num_gop = imgs.shape[1] // GOP
-        i_features_o = i_features = i_features.unsqueeze(1).expand(-1, GOP - 1, -1, -1, -1).reshape(-1, *i_features.shape[-3:])  # (bn gop) c h w
+        B = frames.shape[0]
+        num_gop = frames.shape[1] // GOP
+        i_features = i_features.unsqueeze(1).expand(-1, GOP - 1, -1, -1, -1).reshape(-1, *i_features.shape[-3:])  # (bn gop) c h w
 
         p_motions = einops.rearrange(p_motions, 'bn gop c h w -> (bn gop) c h w')
+        p_features = self.fuse(i_features, p_motions)  # (bn gop) c
+        p_features = p_features.view(B, num_gop, GOP - 1, -1)  # b n k c
+
+        return p_features
+
+    def fuse(self, i_features, p_motions):
+        """
+        Args:
+            i_features: (300, 256, 7, 7), features of the I-frame each P-frame belongs to
+            p_motions: (300, 2, 224, 224)
+        Returns: (300, 256)
+        """
         p_features = self.backbone.extract_features(p_motions)
 
         p_motions_resized = F.interpolate(p_motions, size=p_features.shape[-2:], mode='bilinear', align_corners=False)
 
-        channel_weight = self.channel_module(torch.cat([p_motions_resized, p_features, i_features], dim=1))
+        x = torch.cat([p_motions_resized, p_features, i_features], dim=1)
+        channel_weight = checkpoint_stage(self.channel_module, x, self.checkpoint_estimators)
         weight = self.channel_weight_predictor(F.adaptive_avg_pool2d(channel_weight, 1).flatten(1))  # (300, 256)
         # weight = self.channel_weight_predictor(F.adaptive_max_pool2d(channel_weight, 1).flatten(1))  # (300, 256)
 
         i_features = i_features * weight.unsqueeze(-1).unsqueeze(-1)  # (bn gop) c h w
 
-        spatial_weight = self.spatial_module(torch.cat([p_motions_resized, p_features, i_features], dim=1))
+        x = torch.cat([p_motions_resized, p_features, i_features], dim=1)
+        spatial_weight = checkpoint_stage(self.spatial_module, x, self.checkpoint_estimators)
         spatial_weight = F.softmax(spatial_weight.view(*spatial_weight.shape[:2], -1), dim=-1).view_as(spatial_weight)
         i_features = (i_features * spatial_weight).sum(dim=(2, 3))  # (bn gop) c
 
         p_features = i_features + F.adaptive_avg_pool2d(p_features, 1).flatten(1)  # (bn gop) c
-        p_features = einops.rearrange(p_features, '(b n t) c -> b n t c', b=B, n=num_gop)  # b n k c
-
         return p_features
 
 
@@ -326,31 +402,46 @@ class PositionEmbeddingSine(nn.Module):
 
 def SPoS(inputs, temporal_module, k):
     """(b c t)"""
+    if not temporal_module.training:
+        # without batch statistics the order of the windows does not matter, run every position at once
+        # windows gathered by index rather than unfold, which keeps t dynamic when traced / exported to ONNX
+        positions = torch.arange(inputs.shape[-1], device=inputs.device)
+        window_index = positions[:, None] + torch.arange(2 * k + 1, device=inputs.device)  # t w
+        windows = F.pad(inputs, pad=(k, k), mode='replicate')[:, :, window_index]  # b c t w
+        windows = windows.permute(0, 2, 3, 1).flatten(0, 1)  # (b t) w c
+        h = temporal_module(windows[:, :k], windows[:, k:k + 1], windows[:, k + 1:])  # (b t) c
+        return h.view(inputs.shape[0], inputs.shape[-1], -1).transpose(1, 2)
+
     B = inputs.shape[0]
     L = inputs.shape[-1]
-    C = inputs.shape[1]
 
     padded_inputs = F.pad(inputs, pad=(0, math.ceil(L / k) * k - L), mode='replicate')
-    pad_L = padded_inputs.shape[-1]
 
-    # outputs = torch.zeros_like(padded_inputs)
-    outputs = torch.zeros(B, temporal_module.out_channels, pad_L, dtype=inputs.dtype, device=inputs.device)
-    for offset in range(k):
-        left_x = F.pad(padded_inputs, pad=(k - offset, 0), mode='replicate')[:, :, :-(k - offset)]
-        right_x = F.pad(padded_inputs, pad=(0, offset + 1), mode='replicate')[:, :, (offset + 1):]
-        left_seq = einops.rearrange(left_x, 'b c (nw k) -> (b nw) k c', k=k)
-        right_seq = einops.rearrange(right_x, 'b c (nw k) -> (b nw) k c', k=k)
-        mid_seq = einops.rearrange(padded_inputs[:, :, offset::k], 'b c nw -> (b nw) 1 c')
-
-        h = temporal_module(left_seq, mid_seq, right_seq)  # (b nw) c
-        hidden_state = einops.rearrange(h, '(b nw) c -> b c nw', b=B)
+    # (2k + 1)-frame window centred on every position, replicate-padded at both ends
+    windows = F.pad(padded_inputs, pad=(k, k), mode='replicate').unfold(-1, 2 * k + 1, 1)  # b c t w
+    # group the windows by offset inside their stride-k block, matching the per-offset batches
+    windows = einops.rearrange(windows, 'b c (nw k) w -> k (b nw) w c', k=k)
 
-        outputs[:, :, offset::k] = hidden_state
+    # BatchNorm statistics of the similarity head are computed per offset group
+    h = torch.stack([temporal_module(w[:, :k], w[:, k:k + 1], w[:, k + 1:]) for w in windows], dim=0)
 
+    outputs = einops.rearrange(h, 'k (b nw) c -> b c (nw k)', b=B)
     outputs = outputs[:, :, :L]  # (b c t)
     return outputs
 
 
+def group_cosine_similarity(x):
+    """
+    Same as F.cosine_similarity(x.unsqueeze(2), x.unsqueeze(1), dim=-1).permute(0, 3, 1, 2),
+    without materialising the (B, L, L, G, C') broadcast.
+    Args:
+        x: (B, L, G, C')
+    Returns: (B, G, L, L)
+    """
+    x = F.normalize(x.transpose(1, 2), dim=-1, eps=1e-8)
+    return torch.matmul(x, x.transpose(-1, -2))
+
+
 class BasicConv2d(nn.Module):
     def __init__(self, in_channels: int, out_channels: int, **kwargs):
         super(BasicConv2d, self).__init__()
@@ -364,12 +455,13 @@ class BasicConv2d(nn.Module):
 
 
 class GroupSimilarity(nn.Module):
-    def __init__(self, dim, window_size, group=4, similarity_func='cosine', offset=0):
+    def __init__(self, dim, window_size, group=4, similarity_func='cosine', offset=0, checkpoint_fcn=False):
         super(GroupSimilarity, self).__init__()
         self.out_channels = dim * 1
         self.group = group
         self.similarity_func = similarity_func
         self.offset = offset
+        self.checkpoint_fcn = checkpoint_fcn
 
         k = 5
         padding = (k - 1) // 2
@@ -408,23 +500,20 @@ class GroupSimilarity(nn.Module):
         # x = self.linear(x)
         B, L, C = x.shape
         x = x.view(B, L, self.group, C // self.group)  # (B, L, G, C')
-        # (B, L, L, H)
         similarity_func = self.similarity_func
 
         if similarity_func == 'cosine':
-            sim = F.cosine_similarity(x.unsqueeze(2), x.unsqueeze(1), dim=-1)  # batch, T, T, G
+            sim = group_cosine_similarity(x)  # batch, G, T, T
         else:
             raise NotImplemented
 
-        sim = sim.permute(0, 3, 1, 2)  # batch, G, T, T
-
         # print(sim.shape)
         # import numpy as np
         # global INDEX
         # np.save(f'similarity_maps{INDEX}', sim.detach().cpu().numpy())
         # INDEX += 1
 
-        h = self.fcn(sim)  # batch, dim, T, T
+        h = checkpoint_stage(self.fcn, sim, self.checkpoint_fcn)  # batch, dim, T, T
         h = F.adaptive_avg_pool2d(h, 1).flatten(1)
 
         return h
@@ -464,8 +553,6 @@ class E2ECompressedGEBDModel(Module):
             in_feat_dim = 2048
         else:
             self.backbone = getattr(models, cfg.MODEL.BACKBONE.NAME)(pretrained=True, norm_layer=FrozenBatchNorm2d)
-            for param in itertools.chain(self.backbone.conv1.parameters(), self.backbone.bn1.parameters()):
-                param.requires_grad = False
             in_feat_dim = self.backbone.fc.in_features
             del self.backbone.fc
 
@@ -489,7 +576,8 @@ class E2ECompressedGEBDModel(Module):
         self.temporal_module = GroupSimilarity(dim=dim,
                                                window_size=self.kernel_size,
                                                group=4,
-                                               similarity_func='cosine')
+                                               similarity_func='cosine',
+                                               checkpoint_fcn=cfg.MODEL.CHECKPOINT.SIMILARITY)
 
         self.classifier = nn.Sequential(
             nn.Conv1d(self.temporal_module.out_channels, dim, 3, 1, 1),
@@ -503,46 +591,53 @@ class E2ECompressedGEBDModel(Module):
         # self.fpn = FPN([256, 512, 1024, 2048], dim)
         self.embedding = nn.Conv2d(2048, dim, 3, 1, 1)
         # self.pe = PositionEmbeddingSine(dim, normalize=True)
+        self.checkpoint_layers = set(cfg.MODEL.CHECKPOINT.BACKBONE)
+
+        self.freeze_at = cfg.MODEL.BACKBONE.FREEZE_AT
+        self._use_i_feature_store = bool(cfg.MODEL.I_FEATURE_STORE)
+        assert not (self._use_i_feature_store and (self._use_gan or self.backbone_name in ['csn', 'tsn'])), \
+            'MODEL.I_FEATURE_STORE needs the ResNet I-frame backbone and no GAN.'
+        for param in itertools.chain.from_iterable(module.parameters() for module in self.frozen_modules()):
+            param.requires_grad = False
+
+    def frozen_modules(self):
+        """The first FREEZE_AT stages of the I-frame ResNet, the side-data models freeze their own."""
+        if self.backbone_name in ['csn', 'tsn']:
+            return []
+        if self._use_i_feature_store:
+            # the stored features are outputs of the whole I-frame path
+            return frozen_resnet_modules(self.backbone, 5) + [self.embedding]
+        return frozen_resnet_modules(self.backbone, self.freeze_at)
+
+    def train(self, mode=True):
+        super().train(mode)
+        for module in self.frozen_modules():
+            module.eval()
+        return self
 
     def extract_features(self, x):
         x = einops.rearrange(x, 'b t c h w -> (b t) c h w')
-
-        x = self.backbone.conv1(x)
-        x = self.backbone.bn1(x)
-        x = self.backbone.relu(x)
-        x = self.backbone.maxpool(x)
-
-        outputs = []
-        x = self.backbone.layer1(x)  # (256 * 56 * 56)
-        outputs.append(x)
-        x = self.backbone.layer2(x)  # (512 * 28 * 28)
-        outputs.append(x)
-        x = self.backbone.layer3(x)  # (1024 * 14 * 14)
-        outputs.append(x)
-        x = self.backbone.layer4(x)  # (2048 * 7 * 7)
-        outputs.append(x)
+        x = forward_resnet(self.backbone, x, self.freeze_at, self.checkpoint_layers)  # (2048 * 7 * 7)
 
         # outputs = self.fpn(outputs)[1]
         outputs = self.embedding(x)
         return outputs
 
-    def forward(self, inputs, targets=None):
+    def encode(self, inputs):
         """
+        Per-frame features fed to SPoS.
         Args:
-            inputs(dict): imgs (B, T, C, H, W);
-            targets:
-        Returns:
+            inputs(dict): imgs (B, T, C, H, W); mv (B, T, 2, H, W); res (B, T, 3, H, W); frame_mask (B, T);
+                or i_feats (B, T / GOP, C', h, w), precomputed `extract_features` outputs, instead of imgs
+        Returns: (B, C, T)
         """
-        imgs = inputs['imgs']  # (4, 100, 3, 224, 224)
+        imgs = inputs.get('imgs')  # (4, 100, 3, 224, 224)
         mv = inputs['mv']  # (4, 100, 2, 224, 224)
         res = inputs['res']  # (4, 100, 3, 224, 224)
-        frame_mask = inputs['frame_mask']  # (4, 100)
+        frame_mask = inputs.get('frame_mask')  # (4, 100)
 
-        B = imgs.shape[0]
-        time_cost = {}
-        start = time.perf_counter()
-        i_imgs = imgs[:, ::GOP]  # (4, 8, 3, 224, 224)
-        num_gop = i_imgs.shape[1]
+        B = mv.shape[0]
+        num_gop = mv.shape[1] // GOP
 
         if self._use_gan and self.training:   # Q1: self._use_gan ?
             p_frame_mask = einops.rearrange(frame_mask, 'b (n gop) -> (b n) gop', gop=GOP)
@@ -554,19 +649,21 @@ class E2ECompressedGEBDModel(Module):
         p_motions = einops.rearrange(mv, 'b (n gop) c h w -> (b n) gop c h w', gop=GOP)  #[4, 100, 2, 224, 224] ---> [100, 4, 2, 224, 224]
         p_motions = p_motions[:, 1:]  # [100, 4, 2, 224, 224]
 
-        if self.backbone_name in ['csn', 'tsn']:
-            x = self.backbone(i_imgs)
+        if 'i_feats' in inputs:
+            i_features = inputs['i_feats'].flatten(0, 1).to(mv.dtype)  # [4, 25, 256, 7, 7] ---> [100, 256, 7, 7]
+        elif self.backbone_name in ['csn', 'tsn']:
+            x = self.backbone(imgs[:, ::GOP])
             x = einops.rearrange(x, 'b t c h w -> (b t) c h w')
             i_features = self.embedding(x)
         else:
-            i_features = self.extract_features(i_imgs)  # [4, 25, 3, 224, 224] ---> [100, 256, 7, 7]
+            i_features = self.extract_features(imgs[:, ::GOP])  # [4, 25, 3, 224, 224] ---> [100, 256, 7, 7]
 
         if self._use_mv_as_deconv_params:
-            p_features = self.mv_module(imgs, i_features, p_motions)
+            p_features = self.mv_module(mv, i_features, p_motions)
             if self._use_residual:
                 p_res = einops.rearrange(res, 'b (n gop) c h w -> (b n) gop c h w', gop=GOP)  # (32, 12, 3, 224, 224)
                 p_res = p_res[:, 1:]  # (32, 11, 3, 224, 224)
-                p_features += self.res_module(imgs, i_features, p_res)
+                p_features += self.res_module(mv, i_features, p_res)
             # p_res = einops.rearrange(res, 'b (n gop) c h w -> (b n) gop c h w', gop=GOP)  # (32, 12, 3, 224, 224)
             # p_res = p_res[:, 1:]  # (32, 11, 3, 224, 224)
             # p_features = self.res_module(imgs, i_features, p_res)
@@ -576,22 +673,45 @@ class E2ECompressedGEBDModel(Module):
             p_features = einops.rearrange(p_features, '(b n gop) c h w -> b n gop c h w', b=B, n=num_gop)  # (4, 25, 3, 512, 7, 7)
             p_features = F.adaptive_avg_pool2d(p_features, 1).flatten(3)  # (4, 25, 3, 512)
 
-        i_features = einops.rearrange(i_features, '(b n) c h w -> b n c h w', b=B)  # (4, 8, 512, 7, 7)
-        i_features = F.adaptive_avg_pool2d(i_features, 1).flatten(2)
+        # pooled before splitting b and n, ONNX GlobalAveragePool would also average over c of a 5-d tensor
+        i_features = F.adaptive_avg_pool2d(i_features, 1).flatten(1)  # (32, 512)
+        i_features = i_features.view(B, num_gop, -1)  # (4, 8, 512)
 
-        feats = torch.zeros(B, num_gop, GOP, i_features.shape[-1], dtype=i_features.dtype, device=i_features.device)  # (4, 8, 3, c, h, w)
-        feats[:, :, 0] = i_features
-        feats[:, :, 1:] = p_features
-        time_cost['backbone'] = time.perf_counter() - start
+        feats = torch.cat([i_features.unsqueeze(2), p_features], dim=2)  # (4, 8, 4, c)
         # feats = self.extract_features(einops.rearrange(imgs, 'b t c h w -> (b t) c h w'))  # (32, 2048, 7, 7)
         # feats = F.adaptive_avg_pool2d(feats, 1).flatten(1)
         # feats = einops.rearrange(feats, '(b t) c -> b c t', b=B)
 
         feats = einops.rearrange(feats, 'b n gop c -> b (n gop) c')
         feats = einops.rearrange(feats, 'b t c -> b c t', b=B)  # (4, 512, 100)
+        return feats
 
+    def head(self, feats):
+        """
+        Args:
+            feats: (B, C, T), output of `encode`
+        Returns: logits (B, 1, T)
+        """
         feats = SPoS(feats, self.temporal_module, self.kernel_size)  # b c t
         logits = self.classifier(feats)  # b 1 t
+        return logits
+
+    def forward(self, inputs, targets=None, return_feats=False):
+        """
+        Args:
+            inputs(dict): imgs (B, T, C, H, W);
+            targets:
+            return_feats: also return the output of `encode`, (B, C, T)
+        Returns:
+        """
+        frame_mask = inputs['frame_mask']  # (4, 100)
+
+        time_cost = {}
+        start = time.perf_counter()
+        feats = self.encode(inputs)
+        time_cost['backbone'] = time.perf_counter() - start
+
+        logits = self.head(feats)  # b 1 t
 
         if self.training:
             targets = targets.to(logits.dtype)
@@ -604,4 +724,6 @@ class E2ECompressedGEBDModel(Module):
             return loss_dict
         scores = torch.sigmoid(logits).flatten(1)
         time_cost['head'] = time.perf_counter() - start
+        if return_feats:
+            return scores, time_cost, feats
         return scores, time_cost
@@ -0,0 +1,145 @@
+import copy
+import time
+from contextlib import suppress
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_weights
+from torchvision.ops import FrozenBatchNorm2d
+
+from .e2e_compressed_model_tip import SidedataModel
+
+BATCH_NORMS = (nn.BatchNorm2d, FrozenBatchNorm2d)
+
+
+def fold_conv_bn(conv, bn):
+    """Conv2d computing conv followed by the (eval) batch norm `bn`."""
+    fused = copy.deepcopy(conv)
+    fused.weight, fused.bias = fuse_conv_bn_weights(conv.weight, conv.bias, bn.running_mean, bn.running_var, bn.eps, bn.weight, bn.bias)
+    return fused
+
+
+def fold_batch_norms(module):
+    """
+    Folds in place every batch norm that directly follows a conv: the conv{i} / bn{i} attribute pairs of the
+    ResNet stems and blocks and of BasicConv2d (whose forward calls bn{i} right after conv{i}), and conv -> bn
+    pairs inside nn.Sequential (ResNet downsample). The folded batch norms become nn.Identity.
+    Returns the number of folded batch norms.
+    """
+    num_folded = 0
+    for child in module.modules():
+        if isinstance(child, nn.Sequential):
+            for i in range(len(child) - 1):
+                if isinstance(child[i], nn.Conv2d) and isinstance(child[i + 1], BATCH_NORMS):
+                    child[i] = fold_conv_bn(child[i], child[i + 1])
+                    child[i + 1] = nn.Identity()
+                    num_folded += 1
+            continue
+        for suffix in ('', '1', '2', '3'):
+            conv, bn = getattr(child, f'conv{suffix}', None), getattr(child, f'bn{suffix}', None)
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, BATCH_NORMS):
+                setattr(child, f'conv{suffix}', fold_conv_bn(conv, bn))
+                setattr(child, f'bn{suffix}', nn.Identity())
+                num_folded += 1
+    return num_folded
+
+
+class InputNormConv2d(nn.Module):
+    """
+    conv(bn(x)) with the input batch norm folded into the conv weights.
+    The conv zero-pads the normalized input, the bias bn(0) seen by the border taps is not part of the folded
+    conv and is added back as a per-position offset (depends on the input size only, cached).
+    """
+
+    def __init__(self, conv, bn):
+        super().__init__()
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+        self.conv = copy.deepcopy(conv)
+        self.conv.weight = nn.Parameter(conv.weight * scale.view(1, -1, 1, 1))
+        self.register_buffer('unscaled_weight', conv.weight.detach().clone())
+        self.register_buffer('shift', shift.detach().clone())
+        self._offsets = {}
+
+    def offset(self, height, width):
+        key = (height, width, self.shift.device, self.shift.dtype)
+        if key not in self._offsets:
+            shift = self.shift.view(1, -1, 1, 1).expand(1, -1, height, width)
+            self._offsets[key] = F.conv2d(shift, self.unscaled_weight, None, self.conv.stride, self.conv.padding,
+                                          self.conv.dilation, self.conv.groups)
+        return self._offsets[key]
+
+    def forward(self, x):
+        return self.conv(x) + self.offset(*x.shape[-2:])
+
+
+def fold_input_norms(model):
+    """Folds the input batch norm of every SidedataModel into the first conv of its backbone, in place."""
+    num_folded = 0
+    for module in model.modules():
+        if isinstance(module, SidedataModel) and isinstance(module.bn, nn.BatchNorm2d):
+            module.backbone.conv1 = InputNormConv2d(module.backbone.conv1, module.bn)
+            module.bn = nn.Identity()
+            num_folded += 1
+    return num_folded
+
+
+class InferenceGEBDModel(nn.Module):
+    """
+    Inference-only E2ECompressedGEBDModel: encode -> head -> sigmoid, without the GAN branch and the loss.
+    forward(inputs) returns (scores (B, T), time_cost) like the model in eval mode, encode / head are kept.
+    `auto_cast` (see build_autocast) wraps the forward, the scores are always float32.
+    """
+
+    def __init__(self, model, auto_cast=suppress):
+        super().__init__()
+        self.model = model
+        self.model._use_gan = False
+        self.auto_cast = auto_cast
+        self.eval()
+
+    def train(self, mode=True):
+        assert not mode, 'InferenceGEBDModel can not be trained, optimize_for_inference folds the batch norms.'
+        return super().train(mode)
+
+    def encode(self, inputs):
+        return self.model.encode(inputs)
+
+    def head(self, feats):
+        return self.model.head(feats)
+
+    def forward(self, inputs, return_feats=False):
+        time_cost = {}
+        start = time.perf_counter()
+        with self.auto_cast():
+            feats = self.encode(inputs)
+            time_cost['backbone'] = time.perf_counter() - start
+            logits = self.head(feats)
+
+        scores = torch.sigmoid(logits.float()).flatten(1)
+        time_cost['head'] = time.perf_counter() - start
+        if return_feats:
+            return scores, time_cost, feats
+        return scores, time_cost
+
+
+@torch.no_grad()
+def optimize_for_inference(model, example_inputs=None, atol=1e-4):
+    """
+    Inference copy of an E2ECompressedGEBDModel with the batch norms folded into the convs (backbones,
+    SidedataModel input normalisation, GroupSimilarity.fcn) and the training-only code removed.
+    If `example_inputs` is given, the scores are checked against `model` and a RuntimeError is raised when
+    they differ by more than `atol`.
+    """
+    model = model.eval()
+    optimized = copy.deepcopy(model)
+    fold_batch_norms(optimized)
+    fold_input_norms(optimized)
+    optimized = InferenceGEBDModel(optimized)
+
+    if example_inputs is not None:
+        diff = (optimized(example_inputs)[0] - model(example_inputs)[0]).abs().max().item()
+        if diff > atol:
+            raise RuntimeError(f'Optimized model differs from the original by {diff} > {atol}.')
+    return optimized
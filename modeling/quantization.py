@@ -0,0 +1,115 @@
+import copy
+
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from torchvision.ops import FrozenBatchNorm2d
+
+from .e2e_compressed_model_tip import SidedataModel
+
+
+def frozen_bn_to_bn(module):
+    """Replaces every FrozenBatchNorm2d with an eval nn.BatchNorm2d of the same statistics, which FX fuses into the conv."""
+    for name, child in module.named_children():
+        if isinstance(child, FrozenBatchNorm2d):
+            bn = nn.BatchNorm2d(child.weight.shape[0], eps=child.eps).eval()
+            for key in ('weight', 'bias', 'running_mean', 'running_var'):
+                getattr(bn, key).data.copy_(getattr(child, key))
+            setattr(module, name, bn)
+        else:
+            frozen_bn_to_bn(child)
+    return module
+
+
+def _resnet_stages(backbone, stem=(), embedding=()):
+    """Stages of a torchvision ResNet trunk as called by `extract_features`, each a list of (parent, attribute)."""
+    return [list(stem) + [(backbone, name) for name in ('conv1', 'bn1', 'relu', 'maxpool')]] + \
+           [[(backbone, f'layer{i}')] for i in range(1, 5)] + \
+           [list(embedding)]
+
+
+def conv_stages(model):
+    """
+    Statically quantized parts of an E2ECompressedGEBDModel: the I-frame ResNet, the side-data ResNets and the
+    similarity-map convs of the head. Returns [(stage, input_quantized, output_quantized)], the trunks pass
+    quint8 tensors from one stage to the next and only (de)quantize at their ends.
+    """
+    stages = []
+
+    def add_trunk(trunk_stages):
+        for i, stage in enumerate(trunk_stages):
+            stages.append((stage, i > 0, i < len(trunk_stages) - 1))
+
+    if model.backbone_name not in ('csn', 'tsn'):
+        add_trunk(_resnet_stages(model.backbone, embedding=[(model, 'embedding')]))
+    for module in model.modules():
+        if isinstance(module, SidedataModel):
+            add_trunk(_resnet_stages(module.backbone, stem=[(module, 'bn')], embedding=[(module, 'embedding')]))
+    stages.append(([(model.temporal_module, 'fcn')], False, False))
+    return stages
+
+
+def prepare_static(model, example_inputs, backend='fbgemm'):
+    """
+    Swaps every stage of `conv_stages` for an observed FX GraphModule in place (the first attribute of a stage holds
+    the whole stage, the others become nn.Identity so that `extract_features` runs unchanged).
+    Run the calibration batches through `model`, then `convert_static`.
+    """
+    qconfig = get_default_qconfig(backend)
+    stages = conv_stages(model)
+
+    # inputs of each stage, to trace them
+    stage_inputs = {}
+    hooks = []
+    for i, (stage, _, _) in enumerate(stages):
+        parent, name = stage[0]
+        hooks.append(getattr(parent, name).register_forward_pre_hook(
+            lambda module, args, i=i: stage_inputs.setdefault(i, tuple(x.detach() for x in args))))
+    with torch.no_grad():
+        model(example_inputs)
+    for hook in hooks:
+        hook.remove()
+
+    prepared = []
+    for i, (stage, input_quantized, output_quantized) in enumerate(stages):
+        module = nn.Sequential(*[getattr(parent, name) for parent, name in stage]).eval()
+        custom_config = {
+            'input_quantized_idxs': [0] if input_quantized else [],
+            'output_quantized_idxs': [0] if output_quantized else [],
+        }
+        module = prepare_fx(module, {'': qconfig}, stage_inputs[i], custom_config)
+        for j, (parent, name) in enumerate(stage):
+            setattr(parent, name, module if j == 0 else nn.Identity())
+        prepared.append(stage[0])
+    return prepared
+
+
+def convert_static(prepared):
+    """Replaces the observed stages returned by `prepare_static` with their INT8 versions."""
+    for parent, name in prepared:
+        setattr(parent, name, convert_fx(getattr(parent, name)).eval())
+
+
+def quantize_model(model, calibration_inputs, static=True, dynamic=True, backend='fbgemm'):
+    """
+    Post-training INT8 copy of an E2ECompressedGEBDModel for CPU inference.
+
+    static: convs of the ResNet trunks and of GroupSimilarity.fcn, with activation ranges calibrated on
+        `calibration_inputs` (an iterable of model input dicts, a few val batches).
+    dynamic: the LSTM of the head and the Linear layers, weights in int8 and activations quantized on the fly.
+    """
+    model = frozen_bn_to_bn(copy.deepcopy(model).cpu().eval())
+    torch.backends.quantized.engine = backend
+    if static:
+        calibration_inputs = iter(calibration_inputs)
+        example_inputs = next(calibration_inputs)
+        prepared = prepare_static(model, example_inputs, backend)
+        with torch.no_grad():
+            model(example_inputs)
+            for inputs in calibration_inputs:
+                model(inputs)
+        convert_static(prepared)
+    if dynamic:
+        quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model.eval()
@@ -0,0 +1,125 @@
+from collections import deque
+
+import torch
+import torch.nn.functional as F
+
+from .e2e_compressed_model_tip import GOP
+
+
+class StreamingGEBDDetector(object):
+    """
+    Frame-by-frame inference with an E2ECompressedGEBDModel.
+
+    Every new frame runs the backbone once (ResNet-50 for an I-frame, the mv/res branches for a P-frame)
+    and at most one SPoS window. The score of frame t is emitted once frame t + lookahead has been pushed,
+    where lookahead = kernel_size (SPoS window) + 2 (receptive field of the classifier). Call `flush` at the
+    end of the video to emit the remaining frames. Scores are the same as running the model on the whole
+    sequence at once.
+
+    Usage:
+        detector = StreamingGEBDDetector(model)
+        for img, mv, res in frames:
+            for frame_pos, score in detector.push_frame(img, mv, res):
+                ...
+        for frame_pos, score in detector.flush():
+            ...
+    """
+
+    def __init__(self, model):
+        assert model._use_mv_as_deconv_params and model.backbone_name not in ['csn', 'tsn'], \
+            'Streaming inference only supports the ResNet + UpsampleUpdatingModel2 configuration.'
+        self.model = model.eval()
+        self.k = model.kernel_size
+        # classifier: conv3 -> conv3 -> conv1, each score looks at 2 hidden states on each side
+        self.classifier_context = 2
+        self.lookahead = self.k + self.classifier_context
+        self.reset()
+
+    def reset(self):
+        self.num_frames = 0  # frames pushed so far
+        self.num_hidden = 0  # SPoS outputs computed so far
+        self.num_scores = 0  # scores emitted so far
+        self._i_features = None  # spatial features of the current GOP's I-frame, (1, c, h, w)
+        self._feats = deque(maxlen=2 * self.k + 1)  # last per-frame features, (c,)
+        self._hidden = deque(maxlen=2 * self.classifier_context + 1)  # last SPoS outputs, (c,)
+
+    @torch.no_grad()
+    def push_frame(self, img=None, mv=None, res=None):
+        """
+        Args:
+            img: (3, 224, 224), required for I-frames (every GOP-th frame, starting from the first one)
+            mv: (2, 224, 224), required for P-frames
+            res: (3, 224, 224), required for P-frames
+        Returns:
+            list of (frame_pos, score) that became available, frame_pos counts from 0
+        """
+        model = self.model
+        if self.num_frames % GOP == 0:
+            assert img is not None, 'Frame {} is an I-frame.'.format(self.num_frames)
+            self._i_features = model.extract_features(img[None, None])  # (1, c, h, w)
+            feat = F.adaptive_avg_pool2d(self._i_features, 1).flatten(1)
+        else:
+            assert mv is not None and res is not None, 'Frame {} is a P-frame.'.format(self.num_frames)
+            feat = model.mv_module.fuse(self._i_features, mv[None])
+            if model._use_residual:
+                feat = feat + model.res_module.fuse(self._i_features, res[None])
+        self._feats.append(feat[0])
+        self.num_frames += 1
+
+        return self._advance(self.num_frames - 1 - self.k)
+
+    def push_gop(self, imgs, mv, res):
+        """
+        Args:
+            imgs: (GOP, 3, 224, 224), only the first (I-)frame is used
+            mv: (GOP, 2, 224, 224)
+            res: (GOP, 3, 224, 224)
+        Returns:
+            list of (frame_pos, score)
+        """
+        outputs = self.push_frame(img=imgs[0])
+        for i in range(1, len(mv)):
+            outputs.extend(self.push_frame(mv=mv[i], res=res[i]))
+        return outputs
+
+    @torch.no_grad()
+    def flush(self):
+        """Emits the scores of the last frames, treating the last pushed frame as the end of the video."""
+        outputs = self._advance(self.num_frames - 1, last=True)
+        self.reset()
+        return outputs
+
+    def _advance(self, max_hidden, last=False):
+        """Computes SPoS outputs up to frame `max_hidden` and emits every score that can be computed."""
+        outputs = []
+        while self.num_hidden <= max_hidden:
+            self._hidden.append(self._window_hidden(self.num_hidden))
+            self.num_hidden += 1
+            outputs.extend(self._emit(self.num_hidden - 1 - self.classifier_context))
+        if last:
+            outputs.extend(self._emit(self.num_frames - 1))
+        return outputs
+
+    def _emit(self, max_score):
+        outputs = []
+        while self.num_scores <= max_score:
+            outputs.append((self.num_scores, self._score(self.num_scores)))
+            self.num_scores += 1
+        return outputs
+
+    def _window_hidden(self, center):
+        """SPoS output of one position, borders are replicate padded like `SPoS`."""
+        first = self.num_frames - len(self._feats)  # frame position of self._feats[0]
+        positions = torch.arange(center - self.k, center + self.k + 1).clamp(0, self.num_frames - 1) - first
+        window = torch.stack(list(self._feats), dim=0)[positions][None]  # (1, 2k + 1, c)
+        h = self.model.temporal_module(window[:, :self.k], window[:, self.k:self.k + 1], window[:, self.k + 1:])
+        return h[0]
+
+    def _score(self, t):
+        """Classifier output of frame t, computed on the hidden states within its receptive field."""
+        first = self.num_hidden - len(self._hidden)  # frame position of self._hidden[0]
+        start = max(0, t - self.classifier_context)
+        end = min(self.num_hidden, t + self.classifier_context + 1)
+        hidden = torch.stack(list(self._hidden)[start - first:end - first], dim=1)[None]  # (1, c, t)
+        logits = self.model.classifier(hidden)  # (1, 1, t)
+        return torch.sigmoid(logits[0, 0, t - start]).item()
@@ -0,0 +1,94 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import ConcatDataset, DataLoader, Dataset, DistributedSampler, SequentialSampler
+from tqdm import tqdm
+
+from datasets import build_dataset
+from modeling import cfg, build_model
+from modeling.cpu_profile import build_autocast
+from modeling.e2e_compressed_model_tip import GOP
+from utils.distribute import init_distributed, is_main_process, synchronize
+from utils.feature_store import FeatureWriter, clear_features, save_i_frame_state
+
+
+class IFrameDataset(Dataset):
+    """The I-frame positions (every GOP-th frame) of the windows of a GEBDDataset, as `encode` feeds them to `extract_features`."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset.annotations)
+
+    def __getitem__(self, index):
+        item = self.dataset.annotations[index]
+        block_idx = item['block_idx'][::GOP]
+        return {
+            'vid': item['vid'],
+            'frame_indices': torch.tensor(block_idx),
+            'imgs': torch.stack(self.dataset.load_imgs(item['folder'], block_idx), dim=0),
+        }
+
+
+@torch.no_grad()
+def main(cfg, args):
+    assert cfg.INPUT.END_TO_END and cfg.INPUT.USE_SIDE_DATA, 'The I-frame features are those of the end-to-end side-data windows.'
+    device = torch.device(args.device)
+    model = build_model(cfg).to(device).eval()
+    if args.resume:
+        model.load_state_dict(torch.load(args.resume, map_location='cpu')['model'])
+        print('Loaded from {}'.format(args.resume), flush=True)
+    auto_cast = build_autocast(cfg, device)
+
+    dataset = build_dataset(cfg, args, cfg.DATASETS.TRAIN, is_train=True)
+    dataset = ConcatDataset([IFrameDataset(d) for d in (dataset.datasets if isinstance(dataset, ConcatDataset) else [dataset])])
+    sampler = DistributedSampler(dataset, shuffle=False) if args.distributed else SequentialSampler(dataset)
+    data_loader = DataLoader(dataset, batch_size=args.batch_size, sampler=sampler, num_workers=args.num_workers)
+
+    if is_main_process():
+        clear_features(args.output)
+    synchronize()
+    writer = FeatureWriter(args.output, num_videos=len(sampler), dtype=np.float16)
+    num_frames = 0
+    start_time = time.time()
+    for inputs in tqdm(data_loader, disable=not is_main_process()):
+        imgs = inputs['imgs'].to(device)
+        with auto_cast():
+            feats = model.extract_features(imgs)  # (b n) c h w
+        feats = feats.view(*imgs.shape[:2], *feats.shape[1:])
+        writer.add(inputs['vid'], inputs['frame_indices'].numpy(), feats.float().cpu().numpy())
+        num_frames += imgs.shape[0] * imgs.shape[1]
+    writer.close()
+    elapsed = time.time() - start_time
+
+    synchronize()
+    if is_main_process():
+        save_i_frame_state(model, args.output)
+        size = sum(os.path.getsize(os.path.join(args.output, name)) for name in os.listdir(args.output))
+        print(f'{num_frames} I-frames of {len(writer.index)} videos in {elapsed:.1f}s ({num_frames / max(elapsed, 1e-9):.1f} frames/s), '
+              f'store {args.output}: {size / 2 ** 30:.2f} GB')
+        print(f'Train with MODEL.I_FEATURE_STORE {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the I-frame features (extract_features outputs) of the train windows for MODEL.I_FEATURE_STORE.')
+    parser.add_argument("--config-file", help="path to config file", type=str, default="config/end_to_end_sidedata_mv_res.yaml")
+    parser.add_argument("--local_rank", type=int)
+    parser.add_argument("--resume", type=str, default='', help='checkpoint whose I-frame weights are used, the pretrained initialisation by default')
+    parser.add_argument("--output", type=str, required=True, help='store folder, float16 memory-mapped shards')
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--dist-backend", type=str, default='', help='nccl on cuda and gloo on cpu by default')
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("opts", help="Modify config options using the command-line", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    init_distributed(args)
+
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    main(cfg, args)
@@ -0,0 +1,102 @@
+import argparse
+import itertools
+import os
+import time
+
+import numpy as np
+import torch
+from tabulate import tabulate
+from tqdm import tqdm
+
+from datasets import build_dataloader
+from export import GEBDInferenceModule, export_torchscript
+from inference import load_model
+from modeling import cfg
+from modeling.quantization import quantize_model
+from utils.distribute import pack_predictions
+from utils.eval import counts_to_results, eval_counts, load_gt_dict
+from utils.prediction_store import merge_predictions
+
+KEYS = ('imgs', 'mv', 'res', 'frame_mask')
+
+
+def evaluate(cfg, model, data_loader, rel_dis_thres, max_batches=0):
+    """F1 at every relative distance and ms/frame of `model` on CPU, over the val videos it ran on."""
+    vids, frame_indices, scores = [], [], []
+    model_time_cost = 0
+    num_frames = 0
+    num_batches = len(data_loader) if max_batches <= 0 else min(max_batches, len(data_loader))
+    with torch.no_grad():
+        for inputs in tqdm(itertools.islice(data_loader, num_batches), total=num_batches):
+            samples = {key: inputs[key] for key in KEYS}
+            start_time = time.time()
+            outputs, _ = model(samples)
+            model_time_cost += time.time() - start_time
+            num_frames += samples['imgs'].shape[0] * samples['imgs'].shape[1]
+            vids.extend(inputs['vid'])
+            frame_indices.extend(inputs['frame_indices'].numpy())
+            scores.extend(outputs.float().numpy())
+
+    # the loader caps the split (500 videos, --max-batches), the other annotated videos would count as missed
+    gt_dict = load_gt_dict(f'data/k400_mr345_{data_loader.dataset.split}_min_change_duration0.3.pkl')
+    gt_dict = {vid: gt_dict[vid] for vid in set(vids) if vid in gt_dict}
+    counts = eval_counts(merge_predictions(vids, *pack_predictions(frame_indices, scores)), gt_dict,
+                         threshold=cfg.TEST.THRESHOLD,
+                         rel_dis_thres=rel_dis_thres,
+                         boundary_mode=cfg.TEST.BOUNDARY_MODE,
+                         smooth=cfg.TEST.SMOOTH_WINDOW,
+                         nms_window=cfg.TEST.NMS_WINDOW)
+    results = counts_to_results(rel_dis_thres, *counts)
+    return [results[th][0] for th in rel_dis_thres], model_time_cost * 1000 / num_frames
+
+
+def main(cfg, args):
+    assert cfg.TEST.CHUNK_SIZE == 0, 'Quantization is evaluated on the fixed-length val windows, set TEST.CHUNK_SIZE 0.'
+    assert not cfg.TEST.OPTIMIZE, 'quantize_model fuses the batch norms itself, set TEST.OPTIMIZE False.'
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    data_loader = build_dataloader(cfg, args, cfg.DATASETS.TEST, is_train=False)
+    model = load_model(cfg, args.resume, torch.device('cpu'))
+
+    # activation ranges of the static convs, from the first val batches
+    calibration_inputs = [{key: inputs[key] for key in KEYS} for inputs in itertools.islice(data_loader, args.calib_batches)]
+    quantized_model = quantize_model(model, calibration_inputs, static=not args.no_static, dynamic=not args.no_dynamic, backend=args.backend)
+    print(f'Calibrated on {len(calibration_inputs)} batches ({sum(len(inputs["imgs"]) for inputs in calibration_inputs)} windows).')
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    example_inputs = tuple(calibration_inputs[0][key] for key in ('imgs', 'mv', 'res'))
+    export_torchscript(GEBDInferenceModule(quantized_model), example_inputs, args.output)
+    print(f'Saved INT8 TorchScript to {args.output}, load it with torch.jit.load, (imgs, mv, res) -> scores.')
+
+    rel_dis_thres = [0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5]
+    rows = []
+    for name, m in [('fp32', model), ('int8', quantized_model)]:
+        f1_list, ms_per_frame = evaluate(cfg, m, data_loader, rel_dis_thres, args.max_batches)
+        rows.append([name, f1_list[0], np.mean(f1_list), ms_per_frame])
+    for row in rows:
+        row.append(rows[0][3] / row[3])
+    print(tabulate(rows, headers=['Model', 'F1@0.05', 'Avg F1', 'ms/frame', 'Speedup'], floatfmt='.4f'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Post-training INT8 quantization for CPU inference, F1 and ms/frame against fp32.')
+    parser.add_argument("--config-file", help="path to config file", type=str, default="config/end_to_end_sidedata_mv_res.yaml")
+    parser.add_argument("--resume", type=str, required=True)
+    parser.add_argument("--output", type=str, default='exported/gebd_int8.pt')
+    parser.add_argument("--backend", type=str, default='fbgemm', choices=['fbgemm', 'qnnpack'], help='fbgemm for x86, qnnpack for ARM')
+    parser.add_argument("--calib-batches", type=int, default=8, help='val batches used to calibrate the activation ranges')
+    parser.add_argument("--max-batches", type=int, default=0, help='val batches evaluated, 0 for all')
+    parser.add_argument("--no-static", action='store_true', help='keep the convs in fp32')
+    parser.add_argument("--no-dynamic", action='store_true', help='keep the LSTM / Linear layers in fp32')
+    parser.add_argument("--threads", type=int, default=0, help='torch intra-op threads, 0 keeps the default')
+    parser.add_argument("opts", help="Modify config options using the command-line", default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    # build_dataloader: single process CPU evaluation, which also limits the val set to its first 500 videos
+    args.device = 'cpu'
+    args.distributed = False
+
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    main(cfg, args)
@@ -0,0 +1,195 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from datasets import load_compressed_video
+from inference import load_model
+from modeling import cfg
+from modeling.chunked import chunk_starts, blend_weights, chunk_window, stitch_scores
+from utils.boundary import get_idx_from_score_by_threshold
+
+
+class MicroBatcher(threading.Thread):
+    """
+    Owns the model: runs the windows submitted by all requests in batches of up to `max_batch`,
+    waiting at most `max_wait` seconds after the first queued window for the batch to fill up.
+    """
+
+    def __init__(self, model, max_batch=4, max_wait=0.02):
+        super().__init__(daemon=True)
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.batch_sizes = deque(maxlen=1000)
+
+    def submit(self, window):
+        """Returns a Future of the (chunk_size,) scores of one window."""
+        future = Future()
+        self.queue.put((window, future))
+        return future
+
+    @torch.no_grad()
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(items) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                batch = {key: torch.stack([window[key] for window, _ in items], dim=0).to(self.device) for key in items[0][0]}
+                scores, _ = self.model(batch)  # (b, chunk_size)
+                scores = scores.float().cpu().numpy()
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            self.batch_sizes.append(len(items))
+            for (_, future), window_scores in zip(items, scores):
+                future.set_result(window_scores)
+
+
+class GEBDService(object):
+    """Boundary detection of one mp4 per request, windows of concurrent requests share the model batches."""
+
+    def __init__(self, cfg, model, max_batch, max_wait):
+        self.cfg = cfg
+        self.chunk_size = cfg.TEST.CHUNK_SIZE if cfg.TEST.CHUNK_SIZE > 0 else cfg.INPUT.SEQUENCE_LENGTH
+        self.overlap = cfg.TEST.CHUNK_OVERLAP
+        self.weights = blend_weights(self.chunk_size, self.overlap, cfg.TEST.CHUNK_BLEND)
+        self.batcher = MicroBatcher(model, max_batch, max_wait)
+        self.batcher.start()
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.num_requests = 0
+        self.latencies = deque(maxlen=1000)  # seconds of the last requests
+
+    def predict(self, video_path):
+        start = time.time()
+        with self.lock:
+            self.in_flight += 1
+        try:
+            frame_indices, inputs, fps = load_compressed_video(video_path, self.cfg.INPUT.DOWNSAMPLE)
+            decode_time = time.time() - start
+
+            starts = chunk_starts(len(frame_indices), self.chunk_size, self.overlap)
+            futures = [self.batcher.submit(chunk_window(inputs, s, self.chunk_size)) for s in starts]
+            scores = stitch_scores(len(frame_indices), starts, [future.result() for future in futures], self.weights)
+
+            det_t = get_idx_from_score_by_threshold(threshold=self.cfg.TEST.THRESHOLD,
+                                                    seq_indices=frame_indices,
+                                                    seq_scores=scores,
+                                                    mode=self.cfg.TEST.BOUNDARY_MODE,
+                                                    smooth=self.cfg.TEST.SMOOTH_WINDOW,
+                                                    nms_window=self.cfg.TEST.NMS_WINDOW) / fps
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        latency = time.time() - start
+        with self.lock:
+            self.num_requests += 1
+            self.latencies.append(latency)
+        return {
+            'video': video_path,
+            'boundaries': det_t.tolist(),
+            'num_frames': len(frame_indices),
+            'decode_time': decode_time,
+            'latency': latency,
+        }
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64)
+            stats = {
+                'requests': self.num_requests,
+                'in_flight': self.in_flight,
+                'queued_windows': self.batcher.queue.qsize(),
+                'mean_batch_size': float(np.mean(self.batcher.batch_sizes)) if len(self.batcher.batch_sizes) > 0 else 0.0,
+            }
+        for p in (50, 90, 99):
+            stats[f'latency_p{p}'] = float(np.percentile(latencies, p)) if len(latencies) > 0 else None
+        return stats
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, service.stats())
+            elif self.path == '/health':
+                self._reply(200, {'status': 'ok'})
+            else:
+                self._reply(404, {'error': f'Unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._reply(404, {'error': f'Unknown path {self.path}'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                self._reply(200, service.predict(request['video']))
+            except Exception as e:
+                self._reply(500, {'error': repr(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main(cfg, args):
+    device = torch.device(args.device)
+    model = load_model(cfg, args.resume, device)
+    service = GEBDService(cfg, model, max_batch=args.max_batch or cfg.SOLVER.BATCH_SIZE, max_wait=args.max_wait_ms / 1000)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f'Serving on http://{args.host}:{args.port} (POST /predict {{"video": "path.mp4"}}, GET /stats)', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local HTTP service keeping the model loaded, windows of concurrent requests are micro-batched.')
+    parser.add_argument("--config-file", help="path to config file", type=str)
+    parser.add_argument("--resume", type=str)
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch", type=int, default=0, help='windows per model call, 0 for SOLVER.BATCH_SIZE')
+    parser.add_argument("--max-wait-ms", type=float, default=20, help='longest wait for a batch to fill up')
+    parser.add_argument("opts", help="Modify config options using the command-line", default=None, nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    main(cfg, args)
@@ -0,0 +1,47 @@
+import argparse
+
+import numpy as np
+from tabulate import tabulate
+
+from utils.eval import sweep_f1
+from utils.prediction_store import load_predictions
+
+
+def main(args):
+    results_dict = load_predictions(args.pred_file)
+    print(f'Load results from {args.pred_file}.')
+
+    gt_path = f'data/k400_mr345_{args.split}_min_change_duration0.3.pkl'
+    thresholds = [round(th, 4) for th in args.thresholds]
+    results = sweep_f1(results_dict, gt_path,
+                       thresholds=thresholds,
+                       rel_dis_thres=args.rel_dis_thres,
+                       num_workers=args.num_workers,
+                       boundary_mode=args.boundary_mode,
+                       smooth=args.smooth,
+                       nms_window=args.nms_window)
+
+    tabulate_data = []
+    for th in thresholds:
+        f1_list, rec_list, prec_list = zip(*[results[th][rel] for rel in args.rel_dis_thres])
+        tabulate_data.append([th] + list(f1_list) + [np.mean(f1_list), np.mean(rec_list), np.mean(prec_list)])
+
+    headers = ['Threshold'] + ['F1@{}'.format(rel) for rel in args.rel_dis_thres] + ['Avg F1', 'Avg Rec', 'Avg Prec']
+    print(tabulate(tabulate_data, headers=headers, floatfmt='.4f'))
+
+    best = max(tabulate_data, key=lambda row: row[1])
+    print('Best threshold for F1@{}: {} ({:.4f})'.format(args.rel_dis_thres[0], best[0], best[1]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='F1 over a grid of score thresholds x relative distances, from saved predictions.')
+    parser.add_argument("--pred-file", type=str, required=True, help='model_pred_dict_*.pkl or TEST.PRED_STORE folder saved by validate_end_to_end')
+    parser.add_argument("--split", type=str, default='val')
+    parser.add_argument("--thresholds", type=float, nargs='+', default=np.arange(0.1, 0.95, 0.05).tolist())
+    parser.add_argument("--rel-dis-thres", type=float, nargs='+', default=[0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5])
+    parser.add_argument("--num-workers", type=int, default=0)
+    parser.add_argument("--boundary-mode", type=str, default='center', choices=['center', 'peak'])
+    parser.add_argument("--smooth", type=int, default=1, help='moving average window over the scores')
+    parser.add_argument("--nms-window", type=int, default=5)
+    args = parser.parse_args()
+    main(args)
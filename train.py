@@ -9,22 +9,26 @@ from datetime import timedelta
 
 import numpy as np
 import torch
-import torch.distributed as dist
 from tabulate import tabulate
 from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import MultiStepLR
 from tqdm import tqdm
 
 from datasets import build_dataloader
-from modeling import cfg, build_model
+from modeling import cfg, build_model, ChunkedGEBDDetector
+from modeling.cpu_profile import apply_cpu_profile, build_autocast
 from solver import build_optimizer
-from utils.distribute import synchronize, all_gather, is_main_process
-from utils.eval import eval_f1
+from utils.distribute import synchronize, all_gather_predictions, all_reduce_array, pack_predictions, get_rank, get_world_size, is_main_process
+from utils.distribute import init_distributed
+from utils.eval import eval_f1, eval_counts, counts_to_results, load_gt_dict
+from utils.feature_store import FeatureReader, FeatureWriter, checkpoint_key, clear_features, load_i_frame_state
 from utils.misc import SmoothedValue, MetricLogger
+from utils.prediction_store import PredictionWriter, clear_predictions, load_predictions, merge_predictions
+from utils.resources import plan_resources
 
 
 def make_inputs(inputs, device):
-    keys = ['imgs', 'mv', 'ref_mv', 'origin_mv', 'res', 'frame_mask', 'decode_order', 'video_path', 'rgb_frame_mask', 'y']
+    keys = ['imgs', 'i_feats', 'mv', 'ref_mv', 'origin_mv', 'res', 'frame_mask', 'decode_order', 'video_path', 'rgb_frame_mask', 'y']
     results = {}
     if isinstance(inputs, dict):
         for key in keys:
@@ -79,7 +83,7 @@ def train_one_epoch(cfg, args, model, device, optimizer, data_loader, summary_wr
 
         # ------------ training operations ----------
         optimizer.zero_grad()
-        if cfg.SOLVER.AMPE:
+        if loss_scaler is not None:
             loss_scaler.scale(total_loss).backward()
 
             # print('^'*88)
@@ -106,7 +110,8 @@ def train_one_epoch(cfg, args, model, device, optimizer, data_loader, summary_wr
                 summary_writer.update(**loss_dict)
 
             summary_writer.update(lr=optimizer.param_groups[0]['lr'], total_loss=total_loss,
-                                  total_time=time.time() - start, model_time=time.time() - model_start)
+                                  total_time=time.time() - start, model_time=time.time() - model_start,
+                                  data_time=model_start - start)
             start = time.time()
 
             speed = summary_writer.total_time.avg
@@ -125,7 +130,7 @@ def validate(cfg, model, device, data_loader):
     if cfg.INPUT.END_TO_END:
         return validate_end_to_end(cfg, model, device, data_loader)
 
-    model_pred_dict = {}
+    vid_list, frame_indices_list, scores_list = [], [], []
     model.eval()
     start_time = time.time()
     num_frames = 0
@@ -133,25 +138,21 @@ def validate(cfg, model, device, data_loader):
         samples = make_inputs(inputs, device)
         num_frames += samples['imgs'].shape[0]
 
-        vids = inputs['vid']
-        frame_idxs = inputs['frame_idx']
         scores = model(samples)
 
-        scores = scores.cpu().numpy()
-        for vid, frame_idx, score in zip(vids, frame_idxs, scores):
-            if vid not in model_pred_dict.keys():
-                model_pred_dict[vid] = {}
-                model_pred_dict[vid]['frame_idx'] = []
-                model_pred_dict[vid]['scores'] = []
-            model_pred_dict[vid]['frame_idx'].append(frame_idx)
-            model_pred_dict[vid]['scores'].append(score)
+        # one frame per sample
+        vid_list.extend(inputs['vid'])
+        frame_indices_list.append(inputs['frame_idx'].numpy().reshape(-1))
+        scores_list.append(scores.float().cpu().numpy().reshape(-1))
 
         # if num_frames >= 10000:
         #     break
 
     synchronize()
     metrics = {}
-    data_list = all_gather(model_pred_dict)
+    gathered = all_gather_predictions(vid_list, np.arange(len(vid_list) + 1),
+                                      np.concatenate(frame_indices_list), np.concatenate(scores_list),
+                                      score_dtype=np.dtype(cfg.TEST.GATHER_SCORE_DTYPE))
     if not is_main_process():
         metrics['F1'] = 0.00
         return metrics
@@ -159,26 +160,8 @@ def validate(cfg, model, device, data_loader):
     print('Cost {:.2f}s for evaluating {} videos, {:.4f}s/video'.format(total_time, len(data_loader.dataset), total_time / len(data_loader.dataset)))
     print('{:.9f}ms/frame'.format(total_time * 1000 / num_frames))
 
-    model_pred_dict = defaultdict(dict)
-    for p in data_list:
-        for vid in p:
-            if 'frame_idx' not in model_pred_dict[vid]:
-                model_pred_dict[vid]['frame_idx'] = []
-                model_pred_dict[vid]['scores'] = []
-
-            model_pred_dict[vid]['frame_idx'].extend(p[vid]['frame_idx'])
-            model_pred_dict[vid]['scores'].extend(p[vid]['scores'])
-
-    for vid in model_pred_dict:
-        frame_idx = np.array(model_pred_dict[vid]['frame_idx'])
-        scores = np.array(model_pred_dict[vid]['scores'])
-        _, indices = np.unique(frame_idx, return_index=True)
-        frame_idx = frame_idx[indices]
-        scores = scores[indices]
-
-        indices = np.argsort(frame_idx)
-        model_pred_dict[vid]['frame_idx'] = frame_idx[indices].tolist()
-        model_pred_dict[vid]['scores'] = scores[indices].tolist()
+    # a frame scored twice (sampler padding) keeps its first score, as the per-video merge this replaced
+    model_pred_dict = merge_predictions(*gathered, reduce='first', drop_padding=False)
 
     gt_path = f'data/k400_mr345_{data_loader.dataset.split}_min_change_duration0.3.pkl'
     f1, rec, prec = eval_f1(model_pred_dict, gt_path, threshold=cfg.TEST.THRESHOLD)
@@ -189,55 +172,171 @@ def validate(cfg, model, device, data_loader):
     return metrics
 
 
+def get_feature_store_dir(cfg, data_loader):
+    assert cfg.TEST.FEATURE_STORE and args.resume, 'Features are stored under TEST.FEATURE_STORE, keyed by the --resume checkpoint.'
+    return os.path.join(cfg.TEST.FEATURE_STORE, checkpoint_key(args.resume), data_loader.dataset.split)
+
+
+@torch.no_grad()
+def predict_from_features(model, device, feature_reader, batch_size):
+    """Runs only SPoS + classifier on the features cached by FeatureWriter, returns vids, frame_indices, scores."""
+    model.eval()
+    vid_list, frame_indices_list, scores_list = [], [], []
+    for vids, frame_indices, feats in feature_reader.batches(batch_size):
+        logits = model.head(torch.from_numpy(feats).to(device))
+        vid_list.extend(vids)
+        frame_indices_list.extend(frame_indices)
+        scores_list.extend(torch.sigmoid(logits).flatten(1).cpu().numpy())
+    return vid_list, frame_indices_list, scores_list
+
+
+def iter_videos(data_loader):
+    """(vid, frame_indices, inputs) of every whole video, for loaders built with TEST.CHUNK_SIZE > 0."""
+    for samples in data_loader:
+        for sample in samples:
+            yield sample['vid'], sample['frame_indices'].numpy(), sample
+
+
+def reduce_eval_counts(cfg, data_loader, gt_path, rel_dis_thres, vids, frame_indices, scores):
+    """Matches the videos scored by this rank and sums TP/num_pos/num_det over all ranks, (3, len(rel_dis_thres))."""
+    # DistributedSampler pads the last ranks with videos of the first ones, drop them so that every video counts once
+    num_samples = len(range(get_rank(), len(data_loader.dataset), get_world_size()))
+    results_dict = merge_predictions(vids[:num_samples], *pack_predictions(frame_indices[:num_samples], scores[:num_samples]))
+
+    gt_dict = load_gt_dict(gt_path)
+    local_vids = set(results_dict.keys())
+    if is_main_process():
+        # annotated videos that are not in the dataset count as missed on rank 0
+        dataset_vids = {ann['vid'] for ann in data_loader.dataset.annotations}
+        local_vids.update(vid for vid in gt_dict if vid not in dataset_vids)
+    local_gt_dict = {vid: gt_dict[vid] for vid in gt_dict if vid in local_vids}
+
+    counts = eval_counts(results_dict, local_gt_dict,
+                         threshold=cfg.TEST.THRESHOLD,
+                         rel_dis_thres=rel_dis_thres,
+                         boundary_mode=cfg.TEST.BOUNDARY_MODE,
+                         smooth=cfg.TEST.SMOOTH_WINDOW,
+                         nms_window=cfg.TEST.NMS_WINDOW)
+    return all_reduce_array(counts)
+
+
 @torch.no_grad()
 def validate_end_to_end(cfg, model, device, data_loader):
     metrics = OrderedDict()
+    if args.all_thres:
+        rel_dis_thres = [0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5]
+    else:
+        rel_dis_thres = [0.05]
+    gt_path = f'data/k400_mr345_{data_loader.dataset.split}_min_change_duration0.3.pkl'
+
+    results = None
     if cfg.TEST.PRED_FILE:
         if not is_main_process():
             return metrics
-        with open(cfg.TEST.PRED_FILE, 'rb') as f:
-            results_dict = pickle.load(f)
+        results_dict = load_predictions(cfg.TEST.PRED_FILE)
         print(f'Load results from {cfg.TEST.PRED_FILE}.')
+    elif cfg.TEST.HEAD_ONLY:
+        if not is_main_process():
+            return metrics
+        feature_store = get_feature_store_dir(cfg, data_loader)
+        vids, frame_indices, scores = predict_from_features(model, device, FeatureReader(feature_store), cfg.SOLVER.BATCH_SIZE)
+        print(f'Scored {len(vids)} videos from {feature_store}.')
+        if cfg.TEST.PRED_STORE:
+            clear_predictions(cfg.TEST.PRED_STORE)
+            pred_writer = PredictionWriter(cfg.TEST.PRED_STORE)
+            pred_writer.add(vids, frame_indices, scores)
+            pred_writer.close()
+            print(f'Saved results to {cfg.TEST.PRED_STORE}.')
+        results_dict = merge_predictions(vids, *pack_predictions(frame_indices, scores))
     else:
-        model_pred_dict = defaultdict(dict)
+        vid_list, frame_indices_list, scores_list = [], [], []
         model.eval()
 
+        feature_writer = None
+        if cfg.TEST.DUMP_FEATURES:
+            feature_store = get_feature_store_dir(cfg, data_loader)
+            if is_main_process():
+                clear_features(feature_store)
+            synchronize()
+            feature_writer = FeatureWriter(feature_store, num_videos=len(data_loader.sampler))
+        pred_writer = None
+        if cfg.TEST.PRED_STORE:
+            if is_main_process():
+                clear_predictions(cfg.TEST.PRED_STORE)
+            synchronize()
+            pred_writer = PredictionWriter(cfg.TEST.PRED_STORE)
+        # streamed predictions are read back from the store by rank 0, only the distributed evaluation keeps
+        # those of this rank in memory
+        keep_predictions = pred_writer is None or cfg.TEST.DISTRIBUTED_EVAL
+
+        # bf16 on cpu hosts (CPU.BF16), cuda validation stays in fp32
+        auto_cast = build_autocast(cfg, device) if device.type == 'cpu' else suppress
         model_time_cost = 0
         backbone_time_cost = 0
         head_time_cost = 0
         num_frames = 0
         all_start = time.time()
-        for i, inputs in enumerate(tqdm(data_loader, total=len(data_loader))):
-            samples = make_inputs(inputs, device)
-            num_frames += (samples['imgs'].shape[0] * samples['imgs'].shape[1])
-            start_time = time.time()
-            if args.device == 'cuda':
-                torch.cuda.synchronize()
-            outputs, time_cost = model(samples)  # (b, t)
-            if args.device == 'cuda':
-                torch.cuda.synchronize()
-            model_time_cost += (time.time() - start_time)
-            head_time_cost += time_cost['head']
-            backbone_time_cost += time_cost['backbone']
-            for batch_idx, frame_indices in enumerate(inputs['frame_indices']):
-                vid = inputs['vid'][batch_idx]
-                video_path = inputs['video_path'][batch_idx]
-                scores = outputs[batch_idx]
-                # labels = inputs['labels'][batch_idx]
-                # if is_main_process():
-                #     labels = inputs['labels'][batch_idx]
-                if 'frame_idx' not in model_pred_dict[vid]:
-                    model_pred_dict[vid]['frame_idx'] = []
-                    model_pred_dict[vid]['scores'] = []
-
-                model_pred_dict[vid]['frame_idx'].extend(frame_indices.tolist())
-                model_pred_dict[vid]['scores'].extend(scores.tolist())
-
-            # if num_frames >= 10000:
-            #     break
+        if cfg.TEST.CHUNK_SIZE > 0:
+            assert feature_writer is None, 'TEST.DUMP_FEATURES is not supported with TEST.CHUNK_SIZE.'
+            detector = ChunkedGEBDDetector(model, cfg.TEST.CHUNK_SIZE, cfg.TEST.CHUNK_OVERLAP, cfg.SOLVER.BATCH_SIZE, cfg.TEST.CHUNK_BLEND,
+                                           auto_cast=auto_cast)
+            for vid, frame_indices, scores in detector(iter_videos(tqdm(data_loader, total=len(data_loader)))):
+                num_frames += len(frame_indices)
+                if keep_predictions:
+                    vid_list.append(vid)
+                    frame_indices_list.append(frame_indices)
+                    scores_list.append(scores)
+                if pred_writer is not None:
+                    pred_writer.add([vid], [frame_indices], [scores])
+            model_time_cost = detector.time_cost['model']
+            backbone_time_cost = detector.time_cost['backbone']
+            head_time_cost = detector.time_cost['head']
+        else:
+            for i, inputs in enumerate(tqdm(data_loader, total=len(data_loader))):
+                samples = make_inputs(inputs, device)
+                num_frames += (samples['imgs'].shape[0] * samples['imgs'].shape[1])
+                start_time = time.time()
+                if args.device == 'cuda':
+                    torch.cuda.synchronize()
+                with auto_cast():
+                    if feature_writer is not None:
+                        outputs, time_cost, feats = model(samples, return_feats=True)  # (b, t), (b, c, t)
+                    else:
+                        outputs, time_cost = model(samples)  # (b, t)
+                if feature_writer is not None:
+                    feature_writer.add(inputs['vid'], inputs['frame_indices'].numpy(), feats.float().cpu().numpy())
+                if args.device == 'cuda':
+                    torch.cuda.synchronize()
+                model_time_cost += (time.time() - start_time)
+                head_time_cost += time_cost['head']
+                backbone_time_cost += time_cost['backbone']
+                batch_frame_indices = inputs['frame_indices'].numpy()
+                batch_scores = outputs.float().cpu().numpy()
+                if keep_predictions:
+                    vid_list.extend(inputs['vid'])
+                    frame_indices_list.extend(batch_frame_indices)
+                    scores_list.extend(batch_scores)
+                if pred_writer is not None:
+                    pred_writer.add(inputs['vid'], batch_frame_indices, batch_scores)
+
+                # if num_frames >= 10000:
+                #     break
+
+        if feature_writer is not None:
+            feature_writer.close()
+            if is_main_process():
+                print(f'Saved features to {feature_store}.')
+        if pred_writer is not None:
+            pred_writer.close()
+            if is_main_process():
+                print(f'Saved results to {cfg.TEST.PRED_STORE}.')
 
         synchronize()
-        data_list = all_gather(model_pred_dict)
+        if cfg.TEST.DISTRIBUTED_EVAL:
+            counts = reduce_eval_counts(cfg, data_loader, gt_path, rel_dis_thres, vid_list, frame_indices_list, scores_list)
+        elif pred_writer is None:
+            gathered = all_gather_predictions(vid_list, *pack_predictions(frame_indices_list, scores_list),
+                                              score_dtype=np.dtype(cfg.TEST.GATHER_SCORE_DTYPE))
         if not is_main_process():
             metrics['F1'] = 0.00
             return metrics
@@ -248,59 +347,30 @@ def validate_end_to_end(cfg, model, device, data_loader):
         print('Head {:.9f}ms/frame'.format(head_time_cost * 1000 / num_frames))
         print('All   {:.9f}ms/frame'.format(all_total_time * 1000 / num_frames))
 
-        # model_pred_dict = {}
-        # for p in data_list:
-        #     model_pred_dict.update(p)
-        # print(len(data_list))
-        # print(data_list)
-        model_pred_dict = defaultdict(dict)
-        for p in data_list:
-            for vid in p:
-                for frame_idx, score in zip(p[vid]['frame_idx'], p[vid]['scores']):
-                    if frame_idx not in model_pred_dict[vid]:
-                        model_pred_dict[vid][frame_idx] = []
-
-                    model_pred_dict[vid][frame_idx].append(score)
-
-        # print('model_pred_dict', len(model_pred_dict))
-        # print(model_pred_dict)
-
-        results_dict = defaultdict(dict)
-        for vid in model_pred_dict:
-            frame_idx_list = []
-            scores_list = []
-            for frame_idx in model_pred_dict[vid]:
-                frame_idx_list.append(frame_idx)
-                scores_list.append(np.mean(model_pred_dict[vid][frame_idx]))
-            frame_idx = np.array(frame_idx_list)
-            scores = np.array(scores_list)
-
-            #
-            valid_frame_mask = frame_idx != -1
-            frame_idx = frame_idx[valid_frame_mask]
-            scores = scores[valid_frame_mask]
-
-            indices = np.argsort(frame_idx)
-            results_dict[vid]['frame_idx'] = frame_idx[indices].tolist()
-            results_dict[vid]['scores'] = scores[indices].tolist()
-
-    if not cfg.TEST.PRED_FILE:
-        os.makedirs(args.output_dir, exist_ok=True)
-        save_path = os.path.join(args.output_dir, 'model_pred_dict_{}.pkl'.format(time.strftime('%Y%m%d%H%M%S')))
-        with open(save_path, 'wb') as f:
-            pickle.dump(results_dict, f)
-        print(f'Saved results to {save_path}.')
-
-    if args.all_thres:
-        rel_dis_thres = [0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5]
-    else:
-        rel_dis_thres = [0.05]
-
-    gt_path = f'data/k400_mr345_{data_loader.dataset.split}_min_change_duration0.3.pkl'
-    results, pred_dict, gt_dict = eval_f1(results_dict, gt_path,
-                                          threshold=cfg.TEST.THRESHOLD,
-                                          return_pred_dict=True,
-                                          rel_dis_thres=rel_dis_thres)
+        if cfg.TEST.DISTRIBUTED_EVAL:
+            results = counts_to_results(rel_dis_thres, *counts)
+        elif pred_writer is not None:
+            results_dict = load_predictions(cfg.TEST.PRED_STORE)
+        else:
+            results_dict = merge_predictions(*gathered)
+
+    pred_dict = None
+    if results is None:
+        if not cfg.TEST.PRED_FILE and not cfg.TEST.PRED_STORE:
+            os.makedirs(args.output_dir, exist_ok=True)
+            save_path = os.path.join(args.output_dir, 'model_pred_dict_{}.pkl'.format(time.strftime('%Y%m%d%H%M%S')))
+            with open(save_path, 'wb') as f:
+                pickle.dump(results_dict, f)
+            print(f'Saved results to {save_path}.')
+
+        results, pred_dict, gt_dict = eval_f1(results_dict, gt_path,
+                                              threshold=cfg.TEST.THRESHOLD,
+                                              return_pred_dict=True,
+                                              rel_dis_thres=rel_dis_thres,
+                                              num_workers=cfg.TEST.EVAL_WORKERS,
+                                              boundary_mode=cfg.TEST.BOUNDARY_MODE,
+                                              smooth=cfg.TEST.SMOOTH_WINDOW,
+                                              nms_window=cfg.TEST.NMS_WINDOW)
     list_rec = []
     list_prec = []
     list_f1 = []
@@ -331,18 +401,30 @@ def validate_end_to_end(cfg, model, device, data_loader):
     metrics['Rec'] = rec
     metrics['Prec'] = prec
 
-    with open('GEBD_pred.json', 'w') as f:
-        json.dump(pred_dict, f)
+    if pred_dict is not None:
+        with open('GEBD_pred.json', 'w') as f:
+            json.dump(pred_dict, f)
     return metrics
 
 
 def main(cfg, args):
-    train_data_loader = build_dataloader(cfg, args, cfg.DATASETS.TRAIN, is_train=True)
-    val_data_loader = build_dataloader(cfg, args, cfg.DATASETS.TEST, is_train=False)
+    plan = None
+    if args.device == 'cpu' and cfg.CPU.PLAN_RESOURCES:
+        # planned once, before pinning the main process narrows the cores available_cores() sees, and given to the
+        # workers by build_dataloader; step / data / model times are logged while training
+        plan = plan_resources(cfg)
+        plan.apply_main()
+        if is_main_process():
+            print(plan, flush=True)
+
+    train_data_loader = build_dataloader(cfg, args, cfg.DATASETS.TRAIN, is_train=True, plan=plan)
+    val_data_loader = build_dataloader(cfg, args, cfg.DATASETS.TEST, is_train=False, plan=plan)
 
     device = torch.device(args.device)
 
-    model = build_model(cfg).to(device)
+    # SyncBatchNorm only syncs cuda tensors, with gloo every rank normalises with the statistics of its own batch
+    model = build_model(cfg, sync_bn=cfg.MODEL.SYNC_BN and device.type == 'cuda').to(device)
+    model = apply_cpu_profile(cfg, model, device)
 
     if is_main_process():
         print(model)
@@ -366,6 +448,12 @@ def main(cfg, args):
         if is_main_process():
             print('Loaded from {}, Epoch: {}'.format(args.resume, start_epoch), flush=True)
 
+    if cfg.MODEL.I_FEATURE_STORE:
+        # the I-frame weights the stored features were computed with, also those of the saved checkpoints
+        load_i_frame_state(model, cfg.MODEL.I_FEATURE_STORE)
+        if is_main_process():
+            print('Training from the I-frame features in {}'.format(cfg.MODEL.I_FEATURE_STORE), flush=True)
+
     if args.test_only:
         validate(cfg, model, device, val_data_loader)
         return
@@ -374,7 +462,8 @@ def main(cfg, args):
         f.write(cfg.dump())
 
     if args.distributed:
-        model = DistributedDataParallel(model, device_ids=[args.local_rank], find_unused_parameters=True)
+        device_ids = [args.local_rank] if device.type == 'cuda' else None
+        model = DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=True)
 
     optimizer = build_optimizer(cfg, [p for p in model.parameters() if p.requires_grad], train_data_loader)
     scheduler = MultiStepLR(optimizer, milestones=cfg.SOLVER.MILESTONES)
@@ -390,9 +479,11 @@ def main(cfg, args):
         summary_writer.add_meter('lr', SmoothedValue(fmt='{value:.5f}'))
         summary_writer.add_meter('total_time', SmoothedValue(fmt='{avg:.3f}s'))
         summary_writer.add_meter('model_time', SmoothedValue(fmt='{avg:.3f}s'))
+        summary_writer.add_meter('data_time', SmoothedValue(fmt='{avg:.3f}s'))
 
-    auto_cast = torch.cuda.amp.autocast if cfg.SOLVER.AMPE else suppress
-    loss_scaler = torch.cuda.amp.GradScaler() if cfg.SOLVER.AMPE else None
+    # fp16 + loss scaling on cuda (SOLVER.AMPE), bf16 on cpu (CPU.BF16) needs no loss scaling
+    auto_cast = build_autocast(cfg, device)
+    loss_scaler = torch.cuda.amp.GradScaler() if cfg.SOLVER.AMPE and device.type == 'cuda' else None
 
     for epoch in range(start_epoch + 1, cfg.SOLVER.MAX_EPOCHS):
         train_one_epoch(cfg, args, model, device, optimizer, train_data_loader, summary_writer, auto_cast, loss_scaler, epoch)
@@ -421,21 +512,14 @@ if __name__ == '__main__':
     parser.add_argument("--local_rank", type=int)
     parser.add_argument("--resume", type=str)
     parser.add_argument("--device", type=str, default='cuda')
+    parser.add_argument("--dist-backend", type=str, default='', help='nccl on cuda and gloo on cpu by default')
     parser.add_argument("--test-only", default=False)
     parser.add_argument("--all-thres", default=True, help='test using all thresholds [0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5]')
     parser.add_argument("opts", help="Modify config options using the command-line", default=None, nargs=argparse.REMAINDER)
     args = parser.parse_args()
-    if not args.local_rank:
-        args.local_rank = int(os.environ["LOCAL_RANK"]) if "LOCAL_RANK" in os.environ else 0
-    args.num_gpus = int(os.environ["WORLD_SIZE"]) if "WORLD_SIZE" in os.environ else 1
-    args.distributed = args.num_gpus > 1
-
-    if torch.cuda.is_available():
+    if args.device == 'cuda':
         torch.backends.cudnn.benchmark = True
-        if args.distributed:
-            torch.cuda.set_device(args.local_rank)
-            torch.distributed.init_process_group(backend="nccl", init_method="env://")
-            dist.barrier()
+    init_distributed(args)
 
     cfg.merge_from_file(args.config_file)
     cfg.merge_from_list(args.opts)
@@ -0,0 +1,108 @@
+import numpy as np
+
+
+def find_runs(mask):
+    """
+    Runs of True along the last axis.
+    Args:
+        mask: (..., T) bool
+    Returns:
+        list of index arrays for the leading axes, starts, ends (exclusive), runs are ordered row by row
+    """
+    padded = np.zeros(mask.shape[:-1] + (mask.shape[-1] + 2,), dtype=np.int8)
+    padded[..., 1:-1] = mask
+    diff = np.diff(padded, axis=-1)
+    *rows, starts = np.nonzero(diff == 1)
+    ends = np.nonzero(diff == -1)[-1]
+    return rows, starts, ends
+
+
+def smooth_scores(scores, window=1):
+    """Moving average over `window` (odd) frames along the last axis, borders are replicate padded."""
+    scores = np.asarray(scores, dtype=np.float64)
+    if window <= 1 or scores.shape[-1] == 0:
+        return scores
+    half = window // 2
+    padded = np.pad(scores, [(0, 0)] * (scores.ndim - 1) + [(half, half)], mode='edge')
+    cumsum = np.cumsum(padded, axis=-1)
+    cumsum = np.concatenate([np.zeros(cumsum.shape[:-1] + (1,)), cumsum], axis=-1)
+    return (cumsum[..., 2 * half + 1:] - cumsum[..., :-(2 * half + 1)]) / (2 * half + 1)
+
+
+def peak_nms(scores, threshold=0.5, window=5):
+    """Positions of the local maxima >= threshold, dropping peaks within `window` frames of a higher one."""
+    scores = np.asarray(scores, dtype=np.float64)
+    left = np.concatenate([[-np.inf], scores[:-1]])
+    right = np.concatenate([scores[1:], [-np.inf]])
+    candidates = np.flatnonzero((scores >= threshold) & (scores >= left) & (scores > right))
+
+    keep = []
+    suppressed = np.zeros(len(scores), dtype=bool)
+    for pos in candidates[np.argsort(-scores[candidates], kind='stable')]:
+        if not suppressed[pos]:
+            keep.append(pos)
+            suppressed[max(0, pos - window):pos + window + 1] = True
+    return np.sort(np.array(keep, dtype=np.int64))
+
+
+def _runs_to_idx(seq_indices, starts, ends, mode):
+    if mode == 'center':
+        # int(np.mean(range(start, end)))
+        return seq_indices[(starts + ends - 1) // 2]
+    elif mode == 'range':
+        return np.stack([seq_indices[starts], seq_indices[ends - 1]], axis=-1).reshape(-1, 2)
+    raise NotImplementedError(mode)
+
+
+def get_idx_from_scores(threshold, seq_indices_list, seq_scores_list, mode='center', smooth=1, nms_window=5):
+    """
+    Boundary frame indices of a batch of videos.
+    Args:
+        threshold: score threshold
+        seq_indices_list: list of (T_i,) frame indices
+        seq_scores_list: list of (T_i,) scores
+        mode: 'center' of each run of scores >= threshold,
+              'range' [first, last] frame of each run,
+              'peak' local score maxima >= threshold after NMS over `nms_window` frames
+        smooth: moving average window applied to the scores first, 1 disables it
+    Returns:
+        list of arrays, (n_i,) or (n_i, 2) for 'range'
+    """
+    seq_indices_list = [np.asarray(seq_indices) for seq_indices in seq_indices_list]
+    seq_scores_list = [smooth_scores(seq_scores, smooth) for seq_scores in seq_scores_list]
+
+    if mode == 'peak':
+        return [seq_indices[peak_nms(seq_scores, threshold, nms_window)]
+                for seq_indices, seq_scores in zip(seq_indices_list, seq_scores_list)]
+
+    # one pass over all videos, separated by a below-threshold frame so that runs never cross videos
+    lengths = np.array([len(seq_scores) + 1 for seq_scores in seq_scores_list], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    mask = np.zeros(offsets[-1], dtype=bool)
+    flat_indices = np.zeros(offsets[-1], dtype=np.int64)
+    for i, (seq_indices, seq_scores) in enumerate(zip(seq_indices_list, seq_scores_list)):
+        mask[offsets[i]:offsets[i + 1] - 1] = seq_scores >= threshold
+        flat_indices[offsets[i]:offsets[i + 1] - 1] = seq_indices
+
+    _, starts, ends = find_runs(mask)
+    bdy_indices = _runs_to_idx(flat_indices, starts, ends, mode)
+    video_idx = np.searchsorted(offsets, starts, side='right') - 1
+    return np.split(bdy_indices, np.cumsum(np.bincount(video_idx, minlength=len(lengths)))[:-1])
+
+
+def get_idx_from_score_by_threshold(threshold=0.5, seq_indices=None, seq_scores=None, mode='center', smooth=1, nms_window=5):
+    """Boundary frame indices of one video, see get_idx_from_scores."""
+    return get_idx_from_scores(threshold, [seq_indices], [seq_scores], mode=mode, smooth=smooth, nms_window=nms_window)[0]
+
+
+def get_idx_from_score_by_thresholds(thresholds, seq_indices, seq_scores, mode='center', smooth=1, nms_window=5):
+    """Boundary frame indices of one video for several thresholds at once, list with one array per threshold."""
+    seq_indices = np.asarray(seq_indices)
+    seq_scores = smooth_scores(seq_scores, smooth)
+
+    if mode == 'peak':
+        return [seq_indices[peak_nms(seq_scores, th, nms_window)] for th in thresholds]
+
+    (thres_idx,), starts, ends = find_runs(seq_scores[None, :] >= np.asarray(thresholds)[:, None])
+    bdy_indices = _runs_to_idx(seq_indices, starts, ends, mode)
+    return np.split(bdy_indices, np.cumsum(np.bincount(thres_idx, minlength=len(thresholds)))[:-1])
@@ -1,5 +1,7 @@
+import os
 import pickle
 
+import numpy as np
 import torch
 import torch.distributed as dist
 
@@ -38,6 +40,33 @@ def synchronize():
     dist.barrier()
 
 
+def init_distributed(args):
+    """
+    Process group from the torchrun environment (WORLD_SIZE, RANK, LOCAL_RANK, MASTER_ADDR, MASTER_PORT):
+    nccl with one GPU per process when args.device is cuda, gloo on cpu, or args.dist_backend when given.
+    Sets args.local_rank, args.num_gpus (the number of processes) and args.distributed.
+    """
+    if not args.local_rank:
+        args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    args.num_gpus = int(os.environ.get('WORLD_SIZE', 1))
+    args.distributed = args.num_gpus > 1
+    if not args.distributed:
+        return
+
+    backend = getattr(args, 'dist_backend', '') or ('nccl' if args.device == 'cuda' else 'gloo')
+    if args.device == 'cuda':
+        torch.cuda.set_device(args.local_rank)
+    dist.init_process_group(backend=backend, init_method='env://')
+    dist.barrier()
+
+
+def get_comm_device():
+    """Collectives need CUDA tensors with nccl and CPU tensors with gloo."""
+    if is_dist_avail_and_initialized() and dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
 def all_gather(data):
     """
     Run all_gather on arbitrary picklable data (not necessarily tensors)
@@ -53,11 +82,12 @@ def all_gather(data):
     # serialized to a Tensor
     buffer = pickle.dumps(data)
     storage = torch.ByteStorage.from_buffer(buffer)
-    tensor = torch.ByteTensor(storage).to("cuda")
+    device = get_comm_device()
+    tensor = torch.ByteTensor(storage).to(device)
 
     # obtain Tensor size of each rank
-    local_size = torch.tensor([tensor.numel()], device="cuda")
-    size_list = [torch.tensor([0], device="cuda") for _ in range(world_size)]
+    local_size = torch.tensor([tensor.numel()], device=device)
+    size_list = [torch.tensor([0], device=device) for _ in range(world_size)]
     dist.all_gather(size_list, local_size)
     size_list = [int(size.item()) for size in size_list]
     max_size = max(size_list)
@@ -67,9 +97,9 @@ def all_gather(data):
     # gathering tensors of different shapes
     tensor_list = []
     for _ in size_list:
-        tensor_list.append(torch.empty((max_size,), dtype=torch.uint8, device="cuda"))
+        tensor_list.append(torch.empty((max_size,), dtype=torch.uint8, device=device))
     if local_size != max_size:
-        padding = torch.empty(size=(max_size - local_size,), dtype=torch.uint8, device="cuda")
+        padding = torch.empty(size=(max_size - local_size,), dtype=torch.uint8, device=device)
         tensor = torch.cat((tensor, padding), dim=0)
     dist.all_gather(tensor_list, tensor)
 
@@ -79,3 +109,81 @@ def all_gather(data):
         data_list.append(pickle.loads(buffer))
 
     return data_list
+
+
+def all_reduce_array(array):
+    """Sums a numpy array over all ranks, every rank gets the result."""
+    if get_world_size() == 1:
+        return array
+    tensor = torch.from_numpy(np.ascontiguousarray(array)).to(get_comm_device())
+    dist.all_reduce(tensor)
+    return tensor.cpu().numpy()
+
+
+def all_gather_array(array):
+    """
+    Gathers a 1-D numpy array of any length from each rank.
+    Returns:
+        list[np.ndarray]: arrays of all ranks, in rank order
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return [array]
+
+    device = get_comm_device()
+    tensor = torch.from_numpy(np.ascontiguousarray(array)).to(device)
+    local_size = torch.tensor([tensor.numel()], device=device)
+    size_list = [torch.tensor([0], device=device) for _ in range(world_size)]
+    dist.all_gather(size_list, local_size)
+    size_list = [int(size.item()) for size in size_list]
+    max_size = max(size_list)
+
+    tensor_list = [torch.empty((max_size,), dtype=tensor.dtype, device=device) for _ in size_list]
+    if tensor.numel() != max_size:
+        padding = torch.zeros((max_size - tensor.numel(),), dtype=tensor.dtype, device=device)
+        tensor = torch.cat((tensor, padding), dim=0)
+    dist.all_gather(tensor_list, tensor)
+
+    return [tensor[:size].cpu().numpy() for size, tensor in zip(size_list, tensor_list)]
+
+
+def pack_predictions(frame_indices, scores, score_dtype=np.float32):
+    """
+    Concatenates per-video predictions.
+    Returns:
+        offsets (N + 1,), frame_indices (sum T_i,) int32, scores (sum T_i,), video i owns [offsets[i], offsets[i + 1])
+    """
+    offsets = np.zeros((len(frame_indices) + 1,), dtype=np.int64)
+    offsets[1:] = np.cumsum([len(indices) for indices in frame_indices])
+    frame_indices = np.concatenate(frame_indices).astype(np.int32) if len(frame_indices) > 0 else np.zeros((0,), dtype=np.int32)
+    scores = np.concatenate(scores).astype(score_dtype) if len(scores) > 0 else np.zeros((0,), dtype=score_dtype)
+    return offsets, frame_indices, scores
+
+
+def all_gather_predictions(vids, offsets, frame_indices, scores, score_dtype=np.float32):
+    """
+    Gathers predictions packed into flat arrays (see `pack_predictions`), without pickling.
+    Args:
+        vids: list of N video ids, the same video may appear several times
+        offsets: (N + 1,) segment i owns [offsets[i], offsets[i + 1]) of frame_indices and scores
+        frame_indices: (M,) int
+        scores: (M,) float
+        score_dtype: dtype the scores are sent with, a single process keeps them as they are
+    Returns:
+        vids, offsets, frame_indices, scores of all ranks, packed the same way
+    """
+    names = np.frombuffer('\n'.join(vids).encode('utf-8'), dtype=np.uint8)
+
+    all_vids = []
+    for rank_names in all_gather_array(names):
+        if len(rank_names) > 0:
+            all_vids.extend(rank_names.tobytes().decode('utf-8').split('\n'))
+    lengths = np.concatenate(all_gather_array(np.diff(offsets)))
+    offsets = np.zeros((len(lengths) + 1,), dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    frame_indices = np.concatenate(all_gather_array(np.asarray(frame_indices, dtype=np.int32)))
+    scores = np.asarray(scores)
+    if get_world_size() > 1:
+        scores = scores.astype(score_dtype)
+    scores = np.concatenate(all_gather_array(scores))
+    return all_vids, offsets, frame_indices, scores
@@ -1,12 +1,22 @@
 import pickle
+from multiprocessing import Pool
+
 import numpy as np
 
+from utils.boundary import get_idx_from_scores, get_idx_from_score_by_thresholds
+
 
-def do_eval(gt_dict, pred_dict, threshold=0.05):
-    # recall precision f1 for threshold 0.05(5%)
-    tp_all = 0
-    num_pos_all = 0
-    num_det_all = 0
+def match_counts(gt_dict, pred_dict, thresholds=(0.05,)):
+    """
+    Greedy matching of detected vs. annotated boundaries for every relative distance threshold at once.
+    Returns tp, num_pos, num_det summed over videos, arrays with one entry per threshold.
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    num_thres = len(thresholds)
+    thres_range = np.arange(num_thres)
+    tp_all = np.zeros(num_thres)
+    num_pos_all = np.zeros(num_thres)
+    num_det_all = np.zeros(num_thres)
 
     for vid_id in list(gt_dict.keys()):
 
@@ -18,131 +28,163 @@ def do_eval(gt_dict, pred_dict, threshold=0.05):
             num_pos_all += len(gt_dict[vid_id]['substages_timestamps'][0])
             continue
 
-        # detected timestamps
-        bdy_timestamps_det = pred_dict[vid_id]
-
-        myfps = gt_dict[vid_id]['fps']
         my_dur = gt_dict[vid_id]['video_duration']
-        ins_start = 0
-        ins_end = my_dur
-
-        # remove detected boundary outside the action instance
-        tmp = []
-        for det in bdy_timestamps_det:
-            tmpdet = det + ins_start
-            if tmpdet >= (ins_start) and tmpdet <= (ins_end):
-                tmp.append(tmpdet)
-        bdy_timestamps_det = tmp
-        if bdy_timestamps_det == []:
+
+        # remove detected boundary outside the video
+        bdy_timestamps_det = np.asarray(pred_dict[vid_id], dtype=np.float64)
+        bdy_timestamps_det = bdy_timestamps_det[(bdy_timestamps_det >= 0) & (bdy_timestamps_det <= my_dur)]
+        if len(bdy_timestamps_det) == 0:
             num_pos_all += len(gt_dict[vid_id]['substages_timestamps'][0])
             continue
         num_det = len(bdy_timestamps_det)
         num_det_all += num_det
+        max_offsets = thresholds * my_dur
 
         # compare bdy_timestamps_det vs. each rater's annotation, pick the one leading the best f1 score
         bdy_timestamps_list_gt_allraters = gt_dict[vid_id]['substages_timestamps']
-        f1_tmplist = np.zeros(len(bdy_timestamps_list_gt_allraters))
-        tp_tmplist = np.zeros(len(bdy_timestamps_list_gt_allraters))
-        num_pos_tmplist = np.zeros(len(bdy_timestamps_list_gt_allraters))
-
-        for ann_idx in range(len(bdy_timestamps_list_gt_allraters)):
-            bdy_timestamps_list_gt = bdy_timestamps_list_gt_allraters[ann_idx]
-            num_pos = len(bdy_timestamps_list_gt)
-            tp = 0
-            offset_arr = np.zeros((len(bdy_timestamps_list_gt), len(bdy_timestamps_det)))
-            for ann1_idx in range(len(bdy_timestamps_list_gt)):
-                for ann2_idx in range(len(bdy_timestamps_det)):
-                    offset_arr[ann1_idx, ann2_idx] = abs(bdy_timestamps_list_gt[ann1_idx] - bdy_timestamps_det[ann2_idx])
-            for ann1_idx in range(len(bdy_timestamps_list_gt)):
-                if offset_arr.shape[1] == 0:
-                    break
-                min_idx = np.argmin(offset_arr[ann1_idx, :])
-                if offset_arr[ann1_idx, min_idx] <= threshold * my_dur:
-                    tp += 1
-                    offset_arr = np.delete(offset_arr, min_idx, 1)
-
-            num_pos_tmplist[ann_idx] = num_pos
-            fn = num_pos - tp
-            fp = num_det - tp
-            if num_pos == 0:
-                rec = 1
-            else:
-                rec = tp / (tp + fn)
-            if (tp + fp) == 0:
-                prec = 0
-            else:
-                prec = tp / (tp + fp)
-            if (rec + prec) == 0:
-                f1 = 0
-            else:
-                f1 = 2 * rec * prec / (rec + prec)
-            tp_tmplist[ann_idx] = tp
-            f1_tmplist[ann_idx] = f1
-
-        ann_best = np.argmax(f1_tmplist)
-        tp_all += tp_tmplist[ann_best]
-        num_pos_all += num_pos_tmplist[ann_best]
-
-    fn_all = num_pos_all - tp_all
-    fp_all = num_det_all - tp_all
-    if num_pos_all == 0:
-        rec = 1
-    else:
-        rec = tp_all / (tp_all + fn_all)
-    if (tp_all + fp_all) == 0:
-        prec = 0
-    else:
-        prec = tp_all / (tp_all + fp_all)
-    if (rec + prec) == 0:
-        f1 = 0
-    else:
-        f1 = 2 * rec * prec / (rec + prec)
-
+        num_raters = len(bdy_timestamps_list_gt_allraters)
+        tp_tmplist = np.zeros((num_raters, num_thres))
+        num_pos_tmplist = np.zeros((num_raters, 1))
+
+        for ann_idx in range(num_raters):
+            bdy_timestamps_list_gt = np.asarray(bdy_timestamps_list_gt_allraters[ann_idx], dtype=np.float64)
+            num_pos_tmplist[ann_idx] = len(bdy_timestamps_list_gt)
+            offset_arr = np.abs(bdy_timestamps_list_gt[:, None] - bdy_timestamps_det[None, :])  # (num_pos, num_det)
+
+            # each annotated boundary takes its closest unmatched detection if it is close enough
+            matched = np.zeros((num_thres, num_det), dtype=bool)
+            for offsets in offset_arr:
+                offsets = np.where(matched, np.inf, offsets[None, :])
+                min_idx = np.argmin(offsets, axis=1)
+                hit = offsets[thres_range, min_idx] <= max_offsets
+                matched[thres_range[hit], min_idx[hit]] = True
+                tp_tmplist[ann_idx] += hit
+
+        f1_tmplist = precision_recall_f1(tp_tmplist, num_pos_tmplist, num_det)[0]  # (num_raters, num_thres)
+        ann_best = np.argmax(f1_tmplist, axis=0)
+        tp_all += tp_tmplist[ann_best, thres_range]
+        num_pos_all += num_pos_tmplist[ann_best, 0]
+
+    return tp_all, num_pos_all, num_det_all
+
+
+def precision_recall_f1(tp, num_pos, num_det):
+    """Element-wise, recall is 1 without positives and precision is 0 without detections."""
+    fn = num_pos - tp
+    fp = num_det - tp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rec = np.where(num_pos == 0, 1, tp / (tp + fn))
+        prec = np.where((tp + fp) == 0, 0, tp / (tp + fp))
+        f1 = np.where((rec + prec) == 0, 0, 2 * rec * prec / (rec + prec))
     return f1, rec, prec
 
 
-def get_idx_from_score_by_threshold(threshold=0.5, seq_indices=None, seq_scores=None):
-    seq_indices = np.array(seq_indices)
-    seq_scores = np.array(seq_scores)
-    bdy_indices = []
-    internals_indices = []
-    for i in range(len(seq_scores)):
-        if seq_scores[i] >= threshold:
-            internals_indices.append(i)
-        elif seq_scores[i] < threshold and len(internals_indices) != 0:
-            bdy_indices.append(internals_indices)
-            internals_indices = []
+def do_eval(gt_dict, pred_dict, threshold=0.05, num_workers=0):
+    """
+    recall precision f1 for relative distance threshold 0.05(5%)
+    `threshold` may also be a list, then a dict {threshold: (f1, rec, prec)} is returned.
+    """
+    thresholds = list(threshold) if isinstance(threshold, (list, tuple)) else [threshold]
+
+    if num_workers > 0:
+        vids = list(gt_dict.keys())
+        chunks = [vids[i::num_workers] for i in range(num_workers)]
+        with Pool(num_workers) as pool:
+            counts = pool.starmap(match_counts, [({vid: gt_dict[vid] for vid in chunk},
+                                                  {vid: pred_dict[vid] for vid in chunk if vid in pred_dict},
+                                                  thresholds) for chunk in chunks])
+        tp_all, num_pos_all, num_det_all = [sum(c) for c in zip(*counts)]
+    else:
+        tp_all, num_pos_all, num_det_all = match_counts(gt_dict, pred_dict, thresholds)
+
+    results = counts_to_results(thresholds, tp_all, num_pos_all, num_det_all)
+    if not isinstance(threshold, (list, tuple)):
+        return results[threshold]
+    return results
 
-        if i == len(seq_scores) - 1 and len(internals_indices) != 0:
-            bdy_indices.append(internals_indices)
 
-    bdy_indices_in_video = []
-    if len(bdy_indices) != 0:
-        for internals in bdy_indices:
-            center = int(np.mean(internals))
-            bdy_indices_in_video.append(seq_indices[center])
-    return bdy_indices_in_video
+def counts_to_results(thresholds, tp_all, num_pos_all, num_det_all):
+    """{threshold: (f1, rec, prec)}"""
+    f1, rec, prec = precision_recall_f1(tp_all, num_pos_all, num_det_all)
+    return {thres: (float(f1[i]), float(rec[i]), float(prec[i])) for i, thres in enumerate(thresholds)}
 
 
-def eval_f1(my_pred, gt_path='data/k400_mr345_val_min_change_duration0.3.pkl', threshold=0.5, return_pred_dict=False, rel_dis_thres=0.05):
+def load_gt_dict(gt_path):
     with open(gt_path, 'rb') as f:
-        gt_dict = pickle.load(f, encoding='lartin1')
+        return pickle.load(f, encoding='lartin1')
 
+
+def detect_boundaries(my_pred, gt_dict, threshold=0.5, boundary_mode='center', smooth=1, nms_window=5):
+    """Boundary timestamps {vid: [seconds]} of the videos in both `my_pred` and `gt_dict`."""
+    vids = [vid for vid in my_pred if vid in gt_dict]
+    bdy_indices = get_idx_from_scores(threshold,
+                                      [my_pred[vid]['frame_idx'] for vid in vids],
+                                      [my_pred[vid]['scores'] for vid in vids],
+                                      mode=boundary_mode, smooth=smooth, nms_window=nms_window)
     pred_dict = dict()
-    for vid in my_pred:
-        if vid in gt_dict:
-            # detect boundaries, convert frame_idx to timestamps
-            fps = gt_dict[vid]['fps']
-            det_t = np.array(get_idx_from_score_by_threshold(threshold=threshold,
-                                                             seq_indices=my_pred[vid]['frame_idx'],
-                                                             seq_scores=my_pred[vid]['scores'])) / fps
-            pred_dict[vid] = det_t.tolist()
+    for vid, indices in zip(vids, bdy_indices):
+        pred_dict[vid] = (indices / gt_dict[vid]['fps']).tolist()
+    return pred_dict
+
+
+def eval_f1(my_pred, gt_path='data/k400_mr345_val_min_change_duration0.3.pkl', threshold=0.5, return_pred_dict=False, rel_dis_thres=0.05, num_workers=0,
+            boundary_mode='center', smooth=1, nms_window=5):
+    gt_dict = load_gt_dict(gt_path)
 
-    results = {}
-    for thres in rel_dis_thres:
-        f1, rec, prec = do_eval(gt_dict, pred_dict, threshold=thres)
-        results[thres] = f1, rec, prec
+    # detect boundaries, convert frame_idx to timestamps
+    pred_dict = detect_boundaries(my_pred, gt_dict, threshold, boundary_mode=boundary_mode, smooth=smooth, nms_window=nms_window)
+
+    results = do_eval(gt_dict, pred_dict, threshold=rel_dis_thres, num_workers=num_workers)
 
     if return_pred_dict:
         results = (results,) + (pred_dict, gt_dict)
     return results
+
+
+def eval_counts(my_pred, gt_dict, threshold=0.5, rel_dis_thres=(0.05,), boundary_mode='center', smooth=1, nms_window=5):
+    """
+    Match counts of the videos in `gt_dict`, videos without predictions count as missed.
+    Counts of disjoint subsets of videos add up, see `counts_to_results`.
+    Returns:
+        (3, len(rel_dis_thres)) array of tp, num_pos, num_det
+    """
+    pred_dict = detect_boundaries(my_pred, gt_dict, threshold, boundary_mode=boundary_mode, smooth=smooth, nms_window=nms_window)
+    return np.stack(match_counts(gt_dict, pred_dict, rel_dis_thres))
+
+
+def sweep_f1(my_pred, gt_path='data/k400_mr345_val_min_change_duration0.3.pkl', thresholds=(0.5,), rel_dis_thres=(0.05,), num_workers=0,
+             boundary_mode='center', smooth=1, nms_window=5):
+    """
+    eval_f1 over a grid of score thresholds x relative distance thresholds.
+    Returns {score threshold: {rel_dis_thres: (f1, rec, prec)}}.
+    """
+    gt_dict = load_gt_dict(gt_path)
+
+    pred_dicts = [dict() for _ in thresholds]
+    for vid in my_pred:
+        if vid in gt_dict:
+            fps = gt_dict[vid]['fps']
+            bdy_indices = get_idx_from_score_by_thresholds(thresholds, my_pred[vid]['frame_idx'], my_pred[vid]['scores'],
+                                                           mode=boundary_mode, smooth=smooth, nms_window=nms_window)
+            for pred_dict, indices in zip(pred_dicts, bdy_indices):
+                pred_dict[vid] = (indices / fps).tolist()
+
+    if num_workers > 0:
+        with Pool(num_workers, initializer=_set_gt_dict, initargs=(gt_dict,)) as pool:
+            counts = pool.starmap(_match_counts, [(pred_dict, rel_dis_thres) for pred_dict in pred_dicts])
+    else:
+        counts = [match_counts(gt_dict, pred_dict, rel_dis_thres) for pred_dict in pred_dicts]
+
+    return {thres: counts_to_results(rel_dis_thres, *c) for thres, c in zip(thresholds, counts)}
+
+
+_GT_DICT = None
+
+
+def _set_gt_dict(gt_dict):
+    global _GT_DICT
+    _GT_DICT = gt_dict
+
+
+def _match_counts(pred_dict, thresholds):
+    return match_counts(_GT_DICT, pred_dict, thresholds)
@@ -0,0 +1,113 @@
+import glob
+import os
+import pickle
+
+import numpy as np
+import torch
+
+from utils.distribute import get_rank
+
+I_FRAME_STATE = 'i_frame_state.pth'  # weights of the I-frame backbone + embedding a store of I-frame features was computed with
+
+
+def checkpoint_key(checkpoint_path):
+    """'output/tip_resnet50/model_epoch05.pth' -> 'tip_resnet50_model_epoch05'"""
+    folder, filename = os.path.split(os.path.abspath(checkpoint_path))
+    return '{}_{}'.format(os.path.basename(folder), os.path.splitext(filename)[0])
+
+
+def clear_features(root):
+    """Removes the shards and indexes of every rank in `root`, left by a previous dump possibly with more ranks."""
+    for pattern in ('feats_rank*.npy', 'index_rank*.pkl'):
+        for path in glob.glob(os.path.join(root, pattern)):
+            os.remove(path)
+
+
+class FeatureWriter(object):
+    """
+    Writes the (C, T) features of each video (or any per-video array) to a memory-mapped .npy file of `dtype`.
+    Every rank writes its own shard: feats_rank{rank}.npy and index_rank{rank}.pkl. FeatureReader reads every rank
+    found in `root`, clear it with `clear_features` before the writers of a dump start.
+    """
+
+    def __init__(self, root, num_videos, dtype=np.float32):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.rank = get_rank()
+        self.num_videos = num_videos
+        self.dtype = dtype
+        self.feats = None
+        self.index = {}  # vid -> (row, frame_indices)
+
+    def add(self, vids, frame_indices, feats):
+        """
+        Args:
+            vids: list of B video ids
+            frame_indices: (B, T)
+            feats: (B, C, T)
+        """
+        if self.feats is None:
+            self.feats = np.lib.format.open_memmap(os.path.join(self.root, f'feats_rank{self.rank}.npy'), mode='w+',
+                                                   dtype=self.dtype, shape=(self.num_videos,) + feats.shape[1:])
+        for vid, indices, feat in zip(vids, frame_indices, feats):
+            # DistributedSampler may repeat videos to even out the ranks
+            row = self.index[vid][0] if vid in self.index else len(self.index)
+            self.feats[row] = feat
+            self.index[vid] = (row, np.asarray(indices))
+
+    def close(self):
+        if self.feats is not None:
+            self.feats.flush()
+        with open(os.path.join(self.root, f'index_rank{self.rank}.pkl'), 'wb') as f:
+            pickle.dump(self.index, f)
+
+
+class FeatureReader(object):
+    """Reads back the shards written by FeatureWriter, features stay memory-mapped."""
+
+    def __init__(self, root):
+        index_paths = sorted(glob.glob(os.path.join(root, 'index_rank*.pkl')))
+        assert len(index_paths) > 0, f'No features found in {root}!'
+
+        self.shards = []
+        self.index = {}  # vid -> (shard, row, frame_indices)
+        for index_path in index_paths:
+            rank = os.path.basename(index_path)[len('index_rank'):-len('.pkl')]
+            with open(index_path, 'rb') as f:
+                index = pickle.load(f)
+            if len(index) > 0:
+                self.shards.append(np.load(os.path.join(root, f'feats_rank{rank}.npy'), mmap_mode='r'))
+            for vid, (row, frame_indices) in index.items():
+                self.index[vid] = (len(self.shards) - 1, row, frame_indices)
+        self.vids = sorted(self.index.keys())
+
+    def __len__(self):
+        return len(self.vids)
+
+    def __getitem__(self, vid):
+        """Returns frame_indices (T,) and feats (C, T) of one video."""
+        shard, row, frame_indices = self.index[vid]
+        return frame_indices, self.shards[shard][row]
+
+    def batches(self, batch_size):
+        """Yields vids, frame_indices (B, T) and feats (B, C, T)."""
+        for i in range(0, len(self.vids), batch_size):
+            vids = self.vids[i:i + batch_size]
+            items = [self[vid] for vid in vids]
+            yield vids, np.stack([item[0] for item in items]), np.stack([item[1] for item in items])
+
+
+def i_frame_state_dict(model):
+    """Parameters and buffers of the I-frame path of E2ECompressedGEBDModel: the ResNet and the embedding conv."""
+    return {key: value for key, value in model.state_dict().items() if key.startswith(('backbone.', 'embedding.'))}
+
+
+def save_i_frame_state(model, root):
+    torch.save(i_frame_state_dict(model), os.path.join(root, I_FRAME_STATE))
+
+
+def load_i_frame_state(model, root):
+    """Loads the I-frame weights the features in `root` were computed with, the rest of the model is left as is."""
+    state_dict = torch.load(os.path.join(root, I_FRAME_STATE), map_location='cpu')
+    _, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+    assert len(unexpected_keys) == 0, f'Unexpected keys in {root}: {unexpected_keys}'
@@ -3,6 +3,8 @@ import json
 import numpy as np
 import matplotlib.pyplot as plt
 
+from utils.boundary import get_idx_from_score_by_threshold
+
 plt.switch_backend("agg")
 
 
@@ -155,30 +157,6 @@ def evaluate(predicts, gt_path=None, threshold=0.5, gt_data=None, tol=2):
 
 
 # ------------------------------------------------------------------------------------------------------------------------------------------------
-def get_idx_from_score_by_threshold(threshold=0.5, seq_indices=None, seq_scores=None):
-    seq_indices = np.array(seq_indices)
-    seq_scores = np.array(seq_scores)
-    bdy_indices = []
-    internals_indices = []
-    for i in range(len(seq_scores)):
-        if seq_scores[i] >= threshold:
-            internals_indices.append(i)
-        elif seq_scores[i] < threshold and len(internals_indices) != 0:
-            bdy_indices.append(internals_indices)
-            internals_indices = []
-
-        if i == len(seq_scores) - 1 and len(internals_indices) != 0:
-            bdy_indices.append(internals_indices)
-
-    bdy_indices_in_video = []
-    if len(bdy_indices) != 0:
-        for internals in bdy_indices:
-            # center = int(np.mean(internals))
-            # bdy_indices_in_video.append(seq_indices[center])
-            bdy_indices_in_video.append([seq_indices[internals[0]], seq_indices[internals[-1]]])
-    return bdy_indices_in_video
-
-
 def real_eval(pred_dict, gt_dict, tol=2, threshold=0.4):
     assert tol >= 0
 
@@ -189,9 +167,10 @@ def real_eval(pred_dict, gt_dict, tol=2, threshold=0.4):
     fp_mistakes, fn_mistakes = [], []
     for vid in pred_dict:
         pred = pred_dict[vid]
-        pred_idx = np.array(get_idx_from_score_by_threshold(threshold=threshold,
-                                                            seq_indices=pred['frame_idx'],
-                                                            seq_scores=pred['scores']))
+        pred_idx = get_idx_from_score_by_threshold(threshold=threshold,
+                                                   seq_indices=pred['frame_idx'],
+                                                   seq_scores=pred['scores'],
+                                                   mode='range')
 
         gt_trans = np.array(gt_dict[vid]['transitions'])
 
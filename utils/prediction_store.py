@@ -0,0 +1,172 @@
+import glob
+import os
+import pickle
+from collections import defaultdict
+
+import numpy as np
+
+from utils.distribute import get_rank, pack_predictions
+
+
+def merge_predictions(vids, offsets, frame_indices, scores, reduce='mean', drop_padding=True):
+    """
+    Merges the scores predicted for the same frame of a video and sorts each video by frame index.
+    Inputs are packed as in `pack_predictions`, the same video may appear several times.
+    Args:
+        reduce: 'mean' averages the scores of a repeated frame, 'first' keeps its first occurrence
+        drop_padding: drops the frames with index -1 (padding of the windows)
+    """
+    assert reduce in ('mean', 'first'), reduce
+    vid_names, vid_ids = np.unique(np.array(vids), return_inverse=True)
+    vid_ids = np.repeat(vid_ids.reshape(-1), np.diff(offsets))
+    frame_indices = frame_indices.astype(np.int64)
+    scores = scores.astype(np.float64)
+
+    if drop_padding:
+        valid_frame_mask = frame_indices != -1
+        vid_ids = vid_ids[valid_frame_mask]
+        frame_indices = frame_indices[valid_frame_mask]
+        scores = scores[valid_frame_mask]
+
+    # group by (video, frame), unique keys come out sorted by video then frame index
+    min_frame = np.min(frame_indices, initial=0)
+    num_keys = np.max(frame_indices, initial=0) - min_frame + 1
+    keys, first, inverse, counts = np.unique(vid_ids * num_keys + frame_indices - min_frame,
+                                             return_index=True, return_inverse=True, return_counts=True)
+    if reduce == 'first':
+        merged_scores = scores[first]
+    else:
+        merged_scores = np.bincount(inverse.reshape(-1), weights=scores, minlength=len(keys)) / counts
+
+    splits = np.searchsorted(keys // num_keys, np.arange(1, len(vid_names)))
+    results_dict = defaultdict(dict)
+    for vid, frame_idx, vid_scores in zip(vid_names, np.split(keys % num_keys + min_frame, splits), np.split(merged_scores, splits)):
+        results_dict[vid]['frame_idx'] = frame_idx.tolist()
+        results_dict[vid]['scores'] = vid_scores.tolist()
+    return results_dict
+
+
+def clear_predictions(root):
+    """Removes the shards and indexes of every rank in `root`, left by a previous run possibly with more ranks."""
+    for pattern in ('pred_rank*.npz', 'index_rank*.pkl'):
+        for path in glob.glob(os.path.join(root, pattern)):
+            os.remove(path)
+
+
+class PredictionWriter(object):
+    """
+    Appends (video, frame_idx, score) records to .npz shards of about `shard_size` frames, so that only
+    one shard is held in memory. Every rank writes its own shards, pred_rank{rank}_{shard:05d}.npz with
+    the columns vids, offsets, frame_indices (int32) and scores (float32), and an index_rank{rank}.pkl
+    mapping each video to its (shard, start, end) frame ranges.
+    Shards of the same rank left by a previous run in `root` are replaced, but PredictionReader merges every
+    rank found in `root`: clear it with `clear_predictions` before the writers of a run start. `rank` defaults
+    to the distributed rank, independent processes writing to the same folder pass their own.
+    """
+
+    def __init__(self, root, shard_size=1 << 20, rank=None):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.rank = get_rank() if rank is None else rank
+        self.shard_size = shard_size
+        for path in glob.glob(os.path.join(root, f'pred_rank{self.rank}_*.npz')):
+            os.remove(path)
+
+        self.num_shards = 0
+        self.index = defaultdict(list)  # vid -> [(shard, start, end)]
+        self._reset_buffer()
+
+    def _reset_buffer(self):
+        self._vids, self._frame_indices, self._scores = [], [], []
+        self._num_buffered = 0
+
+    def add(self, vids, frame_indices, scores):
+        """
+        Args:
+            vids: list of B video ids
+            frame_indices: (B, T) or list of B (T_i,)
+            scores: (B, T) or list of B (T_i,)
+        """
+        for vid, indices, vid_scores in zip(vids, frame_indices, scores):
+            self._vids.append(vid)
+            self._frame_indices.append(np.asarray(indices).reshape(-1))
+            self._scores.append(np.asarray(vid_scores, dtype=np.float32).reshape(-1))
+            self._num_buffered += len(self._frame_indices[-1])
+        if self._num_buffered >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._vids) == 0:
+            return
+        shard = f'pred_rank{self.rank}_{self.num_shards:05d}.npz'
+        offsets, frame_indices, scores = pack_predictions(self._frame_indices, self._scores)
+        np.savez(os.path.join(self.root, shard), vids=np.array(self._vids), offsets=offsets,
+                 frame_indices=frame_indices, scores=scores)
+        for vid, start, end in zip(self._vids, offsets[:-1], offsets[1:]):
+            self.index[vid].append((shard, int(start), int(end)))
+        self.num_shards += 1
+        self._reset_buffer()
+
+    def close(self):
+        self.flush()
+        with open(os.path.join(self.root, f'index_rank{self.rank}.pkl'), 'wb') as f:
+            pickle.dump(dict(self.index), f)
+
+
+class PredictionReader(object):
+    """Reads back the shards written by PredictionWriter, one video only loads the shards that contain it."""
+
+    def __init__(self, root):
+        index_paths = sorted(glob.glob(os.path.join(root, 'index_rank*.pkl')))
+        assert len(index_paths) > 0, f'No predictions found in {root}!'
+
+        self.root = root
+        self.index = defaultdict(list)  # vid -> [(shard, start, end)]
+        for index_path in index_paths:
+            with open(index_path, 'rb') as f:
+                for vid, segments in pickle.load(f).items():
+                    self.index[vid].extend(segments)
+        self.vids = sorted(self.index.keys())
+        self._shard_name = None
+        self._shard = None
+
+    def __len__(self):
+        return len(self.vids)
+
+    def __contains__(self, vid):
+        return vid in self.index
+
+    def _load_shard(self, shard):
+        if shard != self._shard_name:
+            with np.load(os.path.join(self.root, shard)) as data:
+                self._shard = {key: data[key] for key in ('frame_indices', 'scores')}
+            self._shard_name = shard
+        return self._shard
+
+    def __getitem__(self, vid):
+        """Returns {'frame_idx': [...], 'scores': [...]} of one video, merged like `merge_predictions`."""
+        frame_indices, scores = [], []
+        for shard, start, end in self.index[vid]:
+            data = self._load_shard(shard)
+            frame_indices.append(data['frame_indices'][start:end])
+            scores.append(data['scores'][start:end])
+        return merge_predictions([vid] * len(frame_indices), *pack_predictions(frame_indices, scores))[vid]
+
+    def to_results_dict(self):
+        """All videos, in the format of `model_pred_dict_*.pkl`."""
+        vids, frame_indices, scores = [], [], []
+        for path in sorted(glob.glob(os.path.join(self.root, 'pred_rank*.npz'))):
+            with np.load(path) as data:
+                offsets = data['offsets']
+                vids.extend(data['vids'].tolist())
+                frame_indices.extend(np.split(data['frame_indices'], offsets[1:-1]))
+                scores.extend(np.split(data['scores'], offsets[1:-1]))
+        return merge_predictions(vids, *pack_predictions(frame_indices, scores))
+
+
+def load_predictions(path):
+    """{vid: {'frame_idx': [...], 'scores': [...]}} from a model_pred_dict_*.pkl or a PredictionWriter folder."""
+    if os.path.isdir(path):
+        return PredictionReader(path).to_results_dict()
+    with open(path, 'rb') as f:
+        return pickle.load(f)
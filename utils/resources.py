@@ -0,0 +1,98 @@
+import os
+
+import torch
+from tabulate import tabulate
+
+
+def available_cores():
+    """Cores this process may run on (its affinity mask, e.g. a cgroup / taskset limit), shared by the ranks of the host."""
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    if local_world_size > 1:
+        # every rank of the host plans within its own slice of the cores
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        per_rank = max(len(cores) // local_world_size, 1)
+        cores = cores[local_rank * per_rank:(local_rank + 1) * per_rank] or cores[-per_rank:]
+    return cores
+
+
+class ResourcePlan(object):
+    """
+    Partition of the cores between the main (compute) process and the DataLoader workers.
+
+    Every worker gets `worker_threads` cores for cv2 / torch / OpenMP preprocessing and the video decoder (decoding
+    and preprocessing alternate, they share the same cores), the main process keeps the rest for its intra-op pool.
+    With `pin`, the main process and each worker are bound to disjoint cores.
+    """
+
+    def __init__(self, cores, num_workers, worker_threads, decoder_threads, main_threads, pin=False):
+        self.cores = list(cores)
+        self.num_workers = num_workers
+        self.worker_threads = worker_threads
+        self.decoder_threads = decoder_threads
+        self.main_threads = main_threads
+        self.pin = pin
+
+    def main_cores(self):
+        return self.cores[:self.main_threads]
+
+    def worker_cores(self, worker_id):
+        """Cores of one worker, wrapping around when the workers are oversubscribed."""
+        data_cores = self.cores[self.main_threads:] or self.cores
+        start = worker_id * self.worker_threads
+        return sorted({data_cores[(start + i) % len(data_cores)] for i in range(self.worker_threads)})
+
+    def apply_main(self):
+        torch.set_num_threads(self.main_threads)
+        if self.pin and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.main_cores())
+
+    def init_worker(self, worker_id):
+        """DataLoader worker_init_fn."""
+        import cv2
+
+        from datasets.dataset import set_decoder_threads
+
+        # OMP / MKL for the processes the worker spawns (decoders), the pools of this process are set directly
+        for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+            os.environ[name] = str(self.worker_threads)
+        torch.set_num_threads(self.worker_threads)
+        cv2.setNumThreads(self.worker_threads)
+        set_decoder_threads(self.decoder_threads)
+        if self.pin and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.worker_cores(worker_id))
+
+    def __str__(self):
+        rows = [['main', self.main_threads, self.main_cores() if self.pin else '-']]
+        rows += [[f'worker {i}', f'{self.worker_threads} (decoder {self.decoder_threads or "-"})', self.worker_cores(i) if self.pin else '-']
+                 for i in range(self.num_workers)]
+        return 'Resource plan for {} cores:\n{}'.format(len(self.cores), tabulate(rows, headers=['Process', 'Threads', 'Cores']))
+
+
+def plan_resources(cfg, num_workers=None, decode_mp4=False):
+    """
+    ResourcePlan from the available cores and the CPU section of the config:
+    CPU.NUM_THREADS > 0 fixes the main process threads, otherwise it gets (1 - CPU.DATA_CORES_FRACTION) of the cores;
+    the workers share the remaining cores, CPU.WORKER_THREADS each (`num_workers` / SOLVER.NUM_WORKERS only cap
+    their number when given).
+    CPU.DECODER_THREADS only budgets the cv2.VideoCapture decoders of workers that `decode_mp4` (inference.py), the
+    side data decoder of the training loader does not take a thread count.
+    """
+    cores = available_cores()
+    decoder_threads = cfg.CPU.DECODER_THREADS if decode_mp4 else 0
+    worker_threads = max(cfg.CPU.WORKER_THREADS, decoder_threads, 1)
+    if cfg.CPU.NUM_THREADS > 0:
+        main_threads = min(cfg.CPU.NUM_THREADS, len(cores))
+    else:
+        main_threads = max(round(len(cores) * (1 - cfg.CPU.DATA_CORES_FRACTION)), 1)
+    data_cores = len(cores) - main_threads
+
+    max_workers = cfg.SOLVER.NUM_WORKERS if num_workers is None else num_workers
+    workers = min(max(data_cores // worker_threads, 0), max_workers)
+    if workers == 0 and max_workers > 0:
+        # no core left for the data, one worker still overlaps loading with compute
+        workers = 1
+    return ResourcePlan(cores, workers, worker_threads, decoder_threads, main_threads, pin=cfg.CPU.PIN_AFFINITY)